@@ -48,6 +48,7 @@ setup(
     install_requires=[
         "zstandard",
         "Pillow",
+        "numpy",
     ],
 
     # List additional groups of dependencies here (e.g. development
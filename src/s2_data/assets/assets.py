@@ -2,25 +2,49 @@ import binascii
 import hashlib
 import io
 import logging
+import mmap
 import os
-from collections import defaultdict
-from concurrent.futures import wait
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from concurrent.futures.thread import ThreadPoolExecutor
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from enum import Enum
+from functools import partial
 from pathlib import Path
-from struct import pack, unpack
+from struct import pack, unpack, unpack_from
 
+import numpy as np
 import zstandard as zstd
 from PIL import Image
 
-from .chacha import Key, chacha, filename_hash
+from .chacha import (Key, chacha, chacha_key, chacha_keys, filename_hash,
+                     filename_hashes, keystream_at)
+from .compression_cache import PNG_CONVERSION_VERSION, CompressionCache
+from .fileio import (atomic_write, copy_range, link_or_copy, read_at,
+                     write_at)
 from .known_assets import IMAGES_DONT_CONVERT, KNOWN_ASSETS
+from .manifest import (Manifest, ManifestEntry, PackedEntry, PackRecord,
+                       data_digest, file_digest)
+from .scan_index import ScanIndex
 
 EXTRACTED_DIR = Path("Extracted")
 OVERRIDES_DIR = Path("Overrides")
+TOC_CACHE_DIR = Path(".compressed") / "toc"
 DEFAULT_COMPRESSION_LEVEL = 20
 BANK_ALIGNMENT = 32
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Threads preparing encrypted payloads while packing, and how many entries
+# they may run ahead of the writer.
+PACK_WORKERS = min(4, os.cpu_count() or 1)
+PACK_PIPELINE_DEPTH = 8
+
+# Compression levels tried, in order, when fitting assets to the original size.
+FIT_COMPRESSION_LEVELS = (3, 7, 12, 16, 19, 22)
+
+# PNG compression level for extracting images as fast as possible, at the
+# cost of larger files.
+PNG_FAST_COMPRESS_LEVEL = 1
 
 
 class MissingAsset(Exception):
@@ -34,6 +58,9 @@ class Asset(object):
     ):
         self.name_hash = name_hash
         self.name_len = name_len
+        # `name_len` before `AssetStore.layout` padded it, so laying out
+        # again doesn't pad twice.
+        self.base_name_len = name_len
         self.filename = filename
         self.asset_data = asset_data
         self.asset_len = asset_len
@@ -43,11 +70,20 @@ class Asset(object):
         self.data_size = data_size
         self.asset_data = asset_data
         self.data = None
+        # Whether `data` has been decrypted already, see `decrypt`.
+        self.decrypted = False
 
     @property
     def total_size(self):
         return 8 + self.name_len + self.asset_len
 
+    def __getstate__(self):
+        # Payloads mapped from an exe can't be sent to other processes.
+        state = self.__dict__.copy()
+        if isinstance(state["data"], memoryview):
+            state["data"] = None
+        return state
+
     def __repr__(self):
         return (
             "Asset("
@@ -73,71 +109,181 @@ class Asset(object):
         """ Cache data on the asset. Must be called before extraction."""
         handle.seek(self.data_offset)
         self.data = handle.read(self.data_size)
+        self.decrypted = False
+
+    def decrypt(self, key):
+        """Decrypt `data` in place, unless it is already."""
+        if self.encrypted and not self.decrypted:
+            self.data = chacha(self.filename, self.data, key)
+            self.decrypted = True
+        return self.data
+
+    def payload_digest(self, key):
+        """Digest of the decrypted payload.
+
+        Encrypted payloads change whenever any asset's size does, as the key
+        is derived from all of them. Decrypted they only change with the
+        asset itself.
+        """
+        return data_digest(self.decrypt(key))
+
+    def extract_paths(self, mods_dir, dest_path):
+        """Paths `extract` writes the asset and its recompressed payload to."""
+        filepath = mods_dir / dest_path / self.filename.decode()
+        compressed_filepath = mods_dir / ".compressed" / dest_path / f"{self.filename.decode()}.zst"
+        if self.converts_to_png:
+            filepath = filepath.with_suffix(".png")
+        return filepath, compressed_filepath
+
+    @property
+    def converts_to_png(self):
+        return self.filename.endswith(b".DDS") and self.filename not in IMAGES_DONT_CONVERT
 
-    def extract(self, mods_dir, dest_path, key, compression_level=DEFAULT_COMPRESSION_LEVEL):
+    def extract(
+        self, mods_dir, dest_path, key, compression_level=None, cache=None,
+        manifest=None, png_compress_level=None
+    ):
+        """Decrypt the asset and write it below `mods_dir / dest_path`.
+
+        The game's compressed payload is kept below `.compressed` for packing
+        the asset unmodified. Packing only recompresses it when the assets
+        don't fit otherwise, see `AssetBundle.shrink_compressed`. With a
+        `compression_level` it is recompressed right away instead.
+
+        With a `CompressionCache` the recompressed payload and the PNG
+        converted from a DDS are shared with other extractions and packs of
+        the same data instead of being redone. A converted image is
+        recompressed the way packing compresses its PNG, keyed by the PNG, so
+        packing it unmodified finds the payload in the cache.
+        `png_compress_level` is passed to `dds_to_png`. The written files are
+        recorded in `manifest` so packing knows they are up to date.
+
+        Returns the path written, or None if recompression failed.
+        """
         if self.data is None:
             raise RuntimeError("load_data hasn't been called.")
 
-        path = mods_dir / dest_path
-        compressed_path = mods_dir / ".compressed" / dest_path
-        filepath = path / self.filename.decode()
-        compressed_filepath = compressed_path / f"{self.filename.decode()}.zst"
-        md5sum_filepath = compressed_path / f"{self.filename.decode()}.md5sum"
-
+        filepath, compressed_filepath = self.extract_paths(mods_dir, dest_path)
 
         if self.encrypted:
             try:
                 # Decrypt
-                self.data = chacha(self.filename, self.data, key)
+                frame = self.decrypt(key)
 
                 # Decompress
                 cctx = zstd.ZstdDecompressor()
-                self.data = cctx.decompress(self.data)
+                self.data = cctx.decompress(frame)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Failed decompression")
+                return None
+
+        # What packing compresses for this asset.
+        payload = self.data
+        if self.converts_to_png:
+            dds_data = self.data
+            if cache is not None:
+                self.data = cache.converted(
+                    data_digest(dds_data),
+                    png_cache_tag(png_compress_level),
+                    lambda: dds_to_png(dds_data, png_compress_level),
+                )
+            else:
+                self.data = dds_to_png(dds_data, png_compress_level)
+
+            def payload():
+                return to_dds(decode_dds(dds_data))
 
-                # Recompress at higher compression level to give
-                # better chance of assets fitting in binary
+        if self.encrypted:
+            try:
                 logging.info("Storing compressed asset %s...", compressed_filepath)
-                with compressed_filepath.open("wb") as compressed_file:
+                if compression_level is None:
+                    atomic_write(compressed_filepath, frame)
+                elif cache is not None:
+                    cached = cache.compress_data(
+                        payload, compression_level, data_digest(self.data),
+                        converted=self.converts_to_png,
+                    )
+                    link_or_copy(cached.path, compressed_filepath)
+                else:
+                    if callable(payload):
+                        payload = payload()
                     cctx = zstd.ZstdCompressor(level=compression_level)
-                    compressed_data = cctx.compress(self.data)
-                    compressed_file.write(compressed_data)
-
+                    atomic_write(compressed_filepath, cctx.compress(payload))
             except Exception:  # pylint: disable=broad-except
                 logging.exception("Failed compression")
                 return None
 
+        logging.info("Storing asset %s...", filepath)
+        with filepath.open("wb") as asset_file:
+            asset_file.write(self.data)
+
+        if manifest is not None:
+            # Record a hash of the uncompressed file to detect if it changes
+            manifest.set(
+                filepath.relative_to(mods_dir),
+                ManifestEntry.for_files(
+                    filepath.stat(), data_digest(self.data), mods_dir,
+                    compressed_filepath if self.encrypted else None,
+                ),
+            )
+        return filepath
 
-        if filepath.suffix == ".DDS" and self.filename not in IMAGES_DONT_CONVERT:
-            image = Image.open(io.BytesIO(self.data))
-            # Swap byte order to read correct endianness
-            image.tile[0] = image.tile[0][:-1] + ((image.tile[0][-1][0][::-1], 0, 1),)
-            new_data = io.BytesIO()
-            image.save(new_data, format="PNG")
-            self.data = new_data.getvalue()
 
-        # Get a hash of the the uncompressed file to be used
-        # to detect if the source file changed
-        md5sum = hashlib.md5(self.data).hexdigest()
-        with md5sum_filepath.open("w") as md5sum_file:
-            md5sum_file.write(md5sum)
+class AssetReader(io.RawIOBase):
+    """Raw reader over an asset's payload that decrypts as it goes.
 
-        logging.info("Storing asset %s...", filepath)
-        if filepath.suffix == ".DDS" and self.filename not in IMAGES_DONT_CONVERT:
-            filepath = filepath.with_suffix(".png")
+    Only `chunk_size` bytes of the payload are held at once, read straight
+    from the store's memory map or with positional reads on its exe handle.
+    """
 
-        with filepath.open("wb") as asset_file:
-            asset_file.write(self.data)
+    def __init__(self, asset_store, asset, key):
+        super().__init__()
+        self.asset_store = asset_store
+        self.asset = asset
+        self.position = 0
+        self.keystream = None
+        if asset.encrypted:
+            self.keystream = chacha_key(asset.filename, asset.data_size, key)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.asset.data_size - self.position)
+        if size <= 0:
+            return 0
+
+        data = self.asset_store.read_payload(self.asset, self.position, size)
+        size = len(data)
+        if self.keystream is None:
+            buffer[:size] = data
+        else:
+            np.bitwise_xor(
+                np.frombuffer(data, dtype=np.uint8),
+                keystream_at(self.keystream, self.asset.data_size, self.position, size),
+                out=np.frombuffer(buffer, dtype=np.uint8, count=size),
+            )
+        self.position += size
+        return size
 
 
 class AssetStore(object):
 
     DATA_OFFSET = 0x400
 
+    # Number of leading name hash bytes used to index assets. Stored hashes
+    # can be longer than the filename hash (soundbanks pad `name_len`), so
+    # only a prefix that every lookup shares can be used as the key.
+    HASH_INDEX_PREFIX = 8
+
     def __init__(self, exe_handle):
         self.assets = []
         self.exe_handle = exe_handle
         self.total_size = 0
         self._key = Key()
+        self._hash_index = None
+        self.buffer = None
+        self.names_populated = False
 
     @property
     def key(self):
@@ -145,6 +291,7 @@ class AssetStore(object):
 
     def update_key(self, size):
         self._key.update(size)
+        self._hash_index = None
 
     def recalculate_key(self):
         new_key = Key()
@@ -153,18 +300,45 @@ class AssetStore(object):
                 continue
             new_key.update(asset.asset_len)
         self._key = new_key
+        self._hash_index = None
 
     def rehash_all_files(self):
-        for asset in self.assets:
-            if asset.filename is None:
-                continue
-            asset.name_hash = self.filename_hash(asset.filename).ljust(asset.name_len, b"\x00")
+        assets = [asset for asset in self.assets if asset.filename is not None]
+        name_hashes = self.filename_hashes(asset.filename for asset in assets)
+        for asset, name_hash in zip(assets, name_hashes):
+            asset.name_hash = name_hash.ljust(asset.name_len, b"\x00")
+        self._hash_index = None
+
+    @property
+    def hash_index(self):
+        """Mapping of name hash prefix to the assets that have it.
+
+        Assets with hashes shorter than the prefix are stored under `None`.
+        Built lazily and dropped whenever the key or the name hashes change.
+        """
+        if self._hash_index is None:
+            index = defaultdict(list)
+            for asset in self.assets:
+                if len(asset.name_hash) < self.HASH_INDEX_PREFIX:
+                    index[None].append(asset)
+                else:
+                    index[asset.name_hash[:self.HASH_INDEX_PREFIX]].append(asset)
+            self._hash_index = dict(index)
+        return self._hash_index
 
     def find_asset(self, filename):
         if filename is None:
             return None
-        name_hash = filename_hash(filename, self.key)
-        for asset in self.assets:
+        return self.find_asset_by_hash(filename_hash(filename, self.key))
+
+    def find_asset_by_hash(self, name_hash):
+        if len(name_hash) < self.HASH_INDEX_PREFIX:
+            candidates = self.assets
+        else:
+            index = self.hash_index
+            candidates = index.get(name_hash[:self.HASH_INDEX_PREFIX], []) + index.get(None, [])
+
+        for asset in candidates:
             if asset.match_hash(name_hash):
                 return asset
         return None
@@ -174,30 +348,191 @@ class AssetStore(object):
             return None
         return filename_hash(filename, self.key)
 
-    def pack_assets(self):
-        self.exe_handle.seek(self.DATA_OFFSET)
+    def filename_hashes(self, filenames):
+        """Hash many filenames at once with the batched chacha engine."""
+        return filename_hashes(filenames, self.key)
 
-        for asset in self.assets:
-            if asset.filename is None:
-                continue
+    def entry_header(self, asset):
+        """Bytes that precede an asset's payload in the exe."""
+        return (
+            pack("<II", asset.asset_len, asset.name_len)
+            + asset.name_hash
+            + pack("<b", asset.encrypted)
+        )
 
+    def packed_entries(self, assets=None, workers=PACK_WORKERS, depth=PACK_PIPELINE_DEPTH):
+        """Yield `(asset, header, payload)` for every asset in exe order.
+
+        With `assets` only those are prepared, in the order given.
+
+        Encrypted payloads are bytes ready to be written. Unencrypted payloads
+        are passed through untouched as the path of their source file so the
+        caller can copy them without reading them into memory.
+
+        Payloads are read and encrypted by `workers` threads up to `depth`
+        entries ahead of the consumer, so reading and encrypting upcoming
+        assets overlaps with writing the current one while memory stays
+        bounded.
+        """
+        if assets is None:
+            assets = [asset for asset in self.assets if asset.filename is not None]
+        encrypted = [asset for asset in assets if asset.encrypted]
+        keystreams = dict(zip(
+            map(id, encrypted),
+            chacha_keys(
+                [asset.filename for asset in encrypted],
+                self.key,
+                [asset.data_size for asset in encrypted],
+            ),
+        ))
+
+        def prepare(asset):
             assert asset.data_size == asset.asset_data.get_data_size()
-            data = asset.asset_data.get_data()
-
             if asset.encrypted:
+                data = asset.asset_data.get_data()
                 logging.info("Encrypting file %s", asset.asset_data.filename)
-                data = chacha(asset.filename, data, self.key)
+                data = chacha(asset.filename, data, self.key, keystreams[id(asset)])
+            else:
+                data = asset.asset_data.file_path
+
+            return asset, self.entry_header(asset), data
 
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            try:
+                for asset in assets:
+                    pending.append(pool.submit(prepare, asset))
+                    if len(pending) >= depth:
+                        yield pending.popleft().result()
+
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def pack_assets(self, out_handle=None):
+        out_handle = out_handle or self.exe_handle
+        out_handle.seek(self.DATA_OFFSET)
+
+        for asset, header, data in self.packed_entries():
             logging.info("Packing file %s", asset.asset_data.filename)
-            self.exe_handle.write(pack("<II", asset.asset_len, asset.name_len))
-            self.exe_handle.write(asset.name_hash)
-            self.exe_handle.write(pack("<b", asset.encrypted))
-            self.exe_handle.write(data)
+            out_handle.write(header)
+
+            if isinstance(data, Path):
+                # Unencrypted payloads such as soundbanks are copied by the
+                # kernel straight from their source file.
+                position = out_handle.tell()
+                with data.open("rb") as src:
+                    copy_range(src, out_handle, 0, position, asset.data_size)
+                out_handle.seek(position + asset.data_size)
+            else:
+                out_handle.write(data)
+
+        out_handle.write(pack("<II", 0, 0))
+
+    def packed_layout(self):
+        """Map each laid out asset's name to its `PackedEntry`."""
+        return {
+            asset.filename.decode(): PackedEntry(
+                asset.offset, asset.asset_len, asset.name_len,
+                asset.asset_data.payload_signature(),
+            )
+            for asset in self.assets
+            if asset.filename is not None
+        }
+
+    def pack_record(self, source, dest_stat):
+        """`PackRecord` of the laid out assets, packed from `source` into an exe with `dest_stat`."""
+        return PackRecord(
+            source, dest_stat.st_size, dest_stat.st_mtime_ns, f"{self.key:016x}", self.packed_layout()
+        )
+
+    def pack_assets_incremental(self, out_handle, previous=None):
+        """Pack into an exe that already holds a previous pack of the same game.
+
+        `previous` is the `PackRecord` of that pack. As long as the key is
+        the same, and with it every asset's offset and size, assets whose
+        payload is also unchanged are skipped without being read or
+        encrypted. Any other header and payload is compared with what is
+        already at its offset in `out_handle` and only rewritten if it
+        differs, so byte ranges before the first changed asset are never
+        touched. Unencrypted payloads that moved are copied from their source
+        file with kernel-side copies where the platform supports them.
+
+        Returns the number of bytes written.
+        """
+        assets = [asset for asset in self.assets if asset.filename is not None]
+        if previous is not None and previous.key == f"{self.key:016x}":
+            layout = self.packed_layout()
+
+            def changed(asset):
+                entry = layout[asset.filename.decode()]
+                return entry.payload is None or previous.entries.get(asset.filename.decode()) != entry
+
+            assets = [asset for asset in assets if changed(asset)]
+
+        written = 0
+        first_changed = None
+
+        for asset, header, data in self.packed_entries(assets):
+            if isinstance(data, Path):
+                payload_written = _sync_file_range(out_handle, asset.data_offset, data, asset.data_size)
+            else:
+                payload_written = _sync_range(out_handle, asset.data_offset, data)
+            header_written = _sync_range(out_handle, asset.offset, header)
+
+            if payload_written or header_written:
+                logging.info("Packing file %s", asset.asset_data.filename)
+                if first_changed is None:
+                    first_changed = asset
+            written += payload_written + header_written
+
+        end = max(
+            (asset.offset + asset.total_size for asset in self.assets if asset.filename is not None),
+            default=self.DATA_OFFSET,
+        )
+        written += _sync_range(out_handle, end, pack("<II", 0, 0))
 
-        self.exe_handle.write(pack("<II", 0, 0))
+        if first_changed is None:
+            logging.info("Packed assets are already up to date")
+        else:
+            logging.info(
+                "Rewrote %d bytes starting at %s (offset %s)",
+                written, first_changed.filename.decode(), hex(first_changed.offset),
+            )
+        return written
 
     @classmethod
-    def load_from_file(cls, exe_handle):
+    def load_from_file(cls, exe_handle, use_mmap=False, toc_cache=None):
+        """Parse the asset table of contents from `exe_handle`.
+
+        With `use_mmap` the executable is memory-mapped instead of read, the
+        table of contents is walked directly over the map and every asset's
+        `data` is a zero-copy memoryview of its payload. The store must then
+        be closed with `close` once the payloads are no longer needed.
+
+        When a `TocCache` is passed the parsed table of contents, including
+        resolved filenames, is reused from it for an already seen exe.
+        """
+        if toc_cache is not None:
+            toc = toc_cache.load(exe_handle)
+            if toc is not None:
+                return cls.from_toc(exe_handle, toc, use_mmap=use_mmap)
+
+        if use_mmap:
+            asset_store = cls._load_from_mmap(exe_handle)
+        else:
+            asset_store = cls._load_from_handle(exe_handle)
+
+        if toc_cache is not None:
+            asset_store.populate_asset_names()
+            toc_cache.store(exe_handle, asset_store.to_toc())
+
+        return asset_store
+
+    @classmethod
+    def _load_from_handle(cls, exe_handle):
         asset_store = cls(exe_handle)
         asset_store.exe_handle.seek(cls.DATA_OFFSET)
 
@@ -211,42 +546,279 @@ class AssetStore(object):
             name_hash = asset_store.exe_handle.read(name_len)
             encrypted = asset_store.exe_handle.read(1) == b"\x01"
             data_offset = asset_store.exe_handle.tell()
-            data_size = asset_len - 1
 
-            asset_store.exe_handle.seek(data_size, 1)
+            asset_store.exe_handle.seek(asset_len - 1, 1)
             asset_store.update_key(asset_len)
+            asset_store.add_asset(offset, asset_len, name_len, name_hash, encrypted, data_offset)
+
+        return asset_store
+
+    @classmethod
+    def _load_from_mmap(cls, exe_handle):
+        asset_store = cls(exe_handle)
+        asset_store.map_exe()
+        offset = cls.DATA_OFFSET
 
-            asset = Asset(
-                name_hash=name_hash,
-                name_len=name_len,
-                filename=None,
-                asset_data=None,
-                asset_len=asset_len,
-                encrypted=encrypted,
-                offset=offset,
-                data_offset=data_offset,
-                data_size=data_size,
+        while True:
+            asset_len, name_len = unpack_from(b"<II", asset_store.buffer, offset)
+            if (asset_len, name_len) == (0, 0):
+                break
+            assert asset_len > 0
+
+            name_hash = asset_store.buffer[offset + 8:offset + 8 + name_len]
+            encrypted = asset_store.buffer[offset + 8 + name_len] == 1
+            data_offset = offset + 8 + name_len + 1
+
+            asset_store.update_key(asset_len)
+            asset = asset_store.add_asset(offset, asset_len, name_len, name_hash, encrypted, data_offset)
+            asset_store.load_data(asset)
+            offset = data_offset + asset.data_size
+
+        return asset_store
+
+    @classmethod
+    def from_toc(cls, exe_handle, toc, use_mmap=False):
+        """Rebuild a store from a table of contents produced by `to_toc`."""
+        asset_store = cls(exe_handle)
+        if use_mmap:
+            asset_store.map_exe()
+        asset_store._key = Key(toc["key"])
+
+        for offset, asset_len, name_len, name_hash, encrypted, data_offset, filename in toc["assets"]:
+            asset = asset_store.add_asset(
+                offset, asset_len, name_len, bytes.fromhex(name_hash), encrypted, data_offset
             )
-            asset_store.assets.append(asset)
-            asset_store.total_size += asset.total_size
+            if filename is not None:
+                asset.filename = filename.encode()
+            if use_mmap:
+                asset_store.load_data(asset)
 
+        asset_store.names_populated = True
         return asset_store
 
+    def to_toc(self):
+        return {
+            "key": self.key,
+            "assets": [
+                [
+                    asset.offset,
+                    asset.asset_len,
+                    asset.name_len,
+                    asset.name_hash.hex(),
+                    asset.encrypted,
+                    asset.data_offset,
+                    asset.filename.decode() if asset.filename is not None else None,
+                ]
+                for asset in self.assets
+            ],
+        }
+
+    def map_exe(self):
+        self.buffer = mmap.mmap(self.exe_handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def add_asset(self, offset, asset_len, name_len, name_hash, encrypted, data_offset):
+        asset = Asset(
+            name_hash=name_hash,
+            name_len=name_len,
+            filename=None,
+            asset_data=None,
+            asset_len=asset_len,
+            encrypted=encrypted,
+            offset=offset,
+            data_offset=data_offset,
+            data_size=asset_len - 1,
+        )
+        self.assets.append(asset)
+        self.total_size += asset.total_size
+        self._hash_index = None
+        return asset
+
+    def load_data(self, asset):
+        """Make sure `asset.data` is populated, reading it from the exe if needed.
+
+        Safe to call from several threads at once.
+        """
+        if asset.data is None:
+            if self.buffer is not None:
+                asset.data = memoryview(self.buffer)[asset.data_offset:asset.data_offset + asset.data_size]
+            else:
+                asset.data = read_at(self.exe_handle, asset.data_offset, asset.data_size)
+            asset.decrypted = False
+        return asset.data
+
+    def unload_data(self, asset):
+        """Drop `asset.data` so its memory can be reclaimed."""
+        if isinstance(asset.data, memoryview):
+            asset.data.release()
+        asset.data = None
+        asset.decrypted = False
+
+    def close(self):
+        """Release the memory map, if any. Payload views are dropped first."""
+        if self.buffer is None:
+            return
+        for asset in self.assets:
+            if isinstance(asset.data, memoryview):
+                asset.data.release()
+                asset.data = None
+        self.buffer.close()
+        self.buffer = None
+
+    def read_payload(self, asset, start=0, size=None):
+        """Read part of an asset's payload without loading all of it."""
+        if size is None:
+            size = asset.data_size - start
+        offset = asset.data_offset + start
+        if self.buffer is not None:
+            return self.buffer[offset:offset + size]
+        return read_at(self.exe_handle, offset, size)
+
+    def open(self, filename, chunk_size=READ_CHUNK_SIZE):
+        """Open a known asset for reading its decrypted, decompressed contents.
+
+        Data is decrypted and decompressed in `chunk_size` pieces as it is
+        read, so memory use stays flat however large the asset is.
+        """
+        if isinstance(filename, str):
+            filename = filename.encode()
+        self.populate_asset_names()
+
+        for asset in self.assets:
+            if asset.filename == filename:
+                return self.open_asset(asset, chunk_size)
+        raise MissingAsset(f"{filename.decode()} is not in this executable")
+
+    def open_asset(self, asset, chunk_size=READ_CHUNK_SIZE):
+        reader = AssetReader(self, asset, self.key)
+        if not asset.encrypted:
+            return io.BufferedReader(reader, chunk_size)
+        return zstd.ZstdDecompressor().stream_reader(reader, read_size=chunk_size)
+
+    def iter_assets(self, chunk_size=READ_CHUNK_SIZE):
+        """Yield `(asset, reader)` for every named asset, in exe order."""
+        self.populate_asset_names()
+        for asset in self.assets:
+            if asset.filename is None:
+                continue
+            with self.open_asset(asset, chunk_size) as reader:
+                yield asset, reader
+
     def populate_asset_names(self):
-        for filename in KNOWN_ASSETS:
-            asset = self.find_asset(filename)
+        if self.names_populated:
+            return
+
+        for filename, name_hash in zip(KNOWN_ASSETS, self.filename_hashes(KNOWN_ASSETS)):
+            asset = self.find_asset_by_hash(name_hash)
             if asset is None:
                 continue
             asset.filename = filename
+        self.names_populated = True
 
     def repackage(
         self, mods_dir, search_dirs, extracted_dir,
-        compression_level=DEFAULT_COMPRESSION_LEVEL
+        compression_level=DEFAULT_COMPRESSION_LEVEL, out_handle=None, incremental=False,
+        **compress_options
+    ):
+        """Lay out assets from `search_dirs` and pack them into `out_handle`.
+
+        `out_handle` defaults to the handle the store was loaded from. With
+        `incremental` it must already contain a previous pack of the same exe,
+        see `pack_assets_incremental`.
+        """
+        self.layout(mods_dir, search_dirs, extracted_dir, compression_level, **compress_options)
+        if incremental:
+            self.pack_assets_incremental(out_handle or self.exe_handle)
+        else:
+            self.pack_assets(out_handle)
+
+    def layout(
+        self, mods_dir, search_dirs, extracted_dir,
+        compression_level=DEFAULT_COMPRESSION_LEVEL, dry_run=False, fit=False, cache=None,
+        asset_bundle=None, manifest=None, scan_index=None, overlay=None, **compress_options
     ):
+        """Resolve, compress and position every asset. Nothing is written to the exe.
+
+        Returns the `AssetBundle` the assets were resolved to. Passing it back
+        as `asset_bundle` skips resolving again, e.g. when only the contents
+        of its source files changed, and passing the same `scan_index` makes
+        resolving again cheap. An `overlay` replaces `search_dirs`, see
+        `AssetBundle.from_dirs`. The store can be laid out any number of times.
+
+        With `dry_run` nothing is written. Compressed payloads are still taken
+        from `cache`, and those missing from it are only compressed in memory
+        to learn their size. The resulting layout can be inspected with
+        `layout_report` but must not be packed.
+
+        With `fit` compression levels are chosen per asset so that the layout
+        fits in the original asset region, see `AssetBundle.fit_to_size`, and
+        `compression_level` is ignored. Otherwise, if the assets don't fit, up
+        to date payloads such as the game's own are recompressed, see
+        `AssetBundle.shrink_compressed`.
+
+        Compressed payloads come from and go to `cache`, which defaults to
+        the shared `CompressionCache`, and what was compressed is recorded in
+        `manifest`, which defaults to the mods directory's. Any other keyword arguments are
+        passed to `AssetBundle.compress`.
+        """
         self.populate_asset_names()
-        asset_bundle = AssetBundle.from_dirs(self, Path(mods_dir), search_dirs, extracted_dir)
-        asset_bundle.compress(compression_level=compression_level)
+        mods_dir = Path(mods_dir)
+        if manifest is None:
+            manifest = Manifest.for_mods_dir(mods_dir)
+        if asset_bundle is None:
+            asset_bundle = AssetBundle.from_dirs(
+                self, mods_dir, search_dirs, extracted_dir,
+                manifest=manifest, scan_index=scan_index, overlay=overlay,
+            )
+        if cache is None:
+            cache = CompressionCache()
+        if dry_run:
+            cache = cache.reader()
+        if fit:
+            data_sizes = asset_bundle.fit_to_size(self, cache, **compress_options)
+        elif dry_run:
+            data_sizes = asset_bundle.planned_sizes(
+                cache, compression_level=compression_level, **compress_options
+            )
+        else:
+            asset_bundle.compress(compression_level=compression_level, cache=cache, **compress_options)
+            data_sizes = None
+
+        if not dry_run:
+            asset_bundle.update_manifest(manifest)
+            manifest.save()
+
+        def data_size(asset_data):
+            if data_sizes is not None:
+                return data_sizes[asset_data.file_path]
+            return asset_data.get_data_size()
+
+        _, end = self.placements(asset_bundle, data_size)
+        if not fit and end - self.DATA_OFFSET > self.total_size:
+            shrunk = asset_bundle.shrink_compressed(cache, dry_run=dry_run, **compress_options)
+            if data_sizes is not None:
+                data_sizes.update(shrunk)
+
+        placements, _ = self.placements(asset_bundle, data_size)
+        for asset, asset_data, offset, padding, size in placements:
+            asset.asset_data = asset_data
+            asset.offset = offset
+            asset.data_size = size
+            asset.name_len = asset.base_name_len + padding
+            asset.data_offset = asset.offset + 8 + asset.name_len + 1
+            asset.asset_len = asset.data_size + 1
 
+        self.recalculate_key()
+        self.rehash_all_files()
+        return asset_bundle
+
+    def placements(self, asset_bundle, data_size):
+        """Work out where every asset of `asset_bundle` goes without changing anything.
+
+        `data_size` is called with each `AssetData` to get its payload size.
+        Returns a list of `(asset, asset_data, offset, padding, data_size)` in
+        exe order and the offset the asset region ends at.
+        """
+        placements = []
         offset = self.DATA_OFFSET
         for asset in self.assets:
             if asset.filename is None:
@@ -255,27 +827,72 @@ class AssetStore(object):
             if asset_data is None:
                 raise MissingAsset(f"FAIL {asset.filename.decode()}")
 
-            asset.asset_data = asset_data
-
-            asset.offset = offset
-            asset.data_size = asset_data.get_data_size()
-            asset.data_offset = asset.offset + 8 + asset.name_len + 1
+            size = data_size(asset_data)
+            data_offset = offset + 8 + asset.base_name_len + 1
 
             # The name hash of soundbank files is padded such that the data_offset
             # is divisible by 32.
             #
             # Padding is between 1 and 32 bytes
+            padding = 0
             if asset_data.file_path.suffix == ".bank":
-                padding = BANK_ALIGNMENT - asset.data_offset % BANK_ALIGNMENT
-                asset.name_len += padding
-                asset.data_offset += padding
-
-            asset.asset_len = asset.data_size + 1
-            offset += asset.total_size
-
-        self.recalculate_key()
-        self.rehash_all_files()
-        self.pack_assets()
+                padding = BANK_ALIGNMENT - data_offset % BANK_ALIGNMENT
+
+            placements.append((asset, asset_data, offset, padding, size))
+            offset = data_offset + padding + size
+
+        return placements, offset
+
+    def layout_report(self):
+        """Describe the current layout and how it compares to the original region.
+
+        `original_size` is the size of the asset region in the exe the store
+        was loaded from, including the terminating entry, and `size` is the
+        same for the laid out assets.
+        """
+        assets = [asset for asset in self.assets if asset.filename is not None]
+        end = max((asset.offset + asset.total_size for asset in assets), default=self.DATA_OFFSET)
+        size = end - self.DATA_OFFSET + 8
+        original_size = self.total_size + 8
+
+        return {
+            "original_size": original_size,
+            "size": size,
+            "fits": size <= original_size,
+            "assets": [
+                {
+                    "filename": asset.filename.decode(),
+                    "source": str(asset.asset_data.path / asset.asset_data.filename),
+                    "encrypted": bool(asset.encrypted),
+                    "offset": asset.offset,
+                    "data_size": asset.data_size,
+                    "padding": asset.name_len - len(asset.filename),
+                    "total_size": asset.total_size,
+                }
+                for asset in assets
+            ],
+        }
+
+
+def _sync_range(handle, offset, data):
+    """Write `data` at `offset` unless it is already there. Returns bytes written."""
+    if read_at(handle, offset, len(data)) == data:
+        return 0
+    write_at(handle, offset, data)
+    return len(data)
+
+
+def _sync_file_range(handle, offset, path, size):
+    """Like `_sync_range` but for the contents of the file at `path`."""
+    with path.open("rb") as src:
+        position = 0
+        while position < size:
+            chunk_size = min(READ_CHUNK_SIZE, size - position)
+            if read_at(src, position, chunk_size) != read_at(handle, offset + position, chunk_size):
+                copy_range(src, handle, position, offset + position, size - position)
+                return size - position
+            position += chunk_size
+    return 0
 
 
 class ResolutionPolicy(Enum):
@@ -285,47 +902,172 @@ class ResolutionPolicy(Enum):
 
 
 class FileConflict(Exception):
-    pass
+    """Raised with every file provided by more than one pack of the same priority.
+
+    `conflicts` maps each file name to the search dirs providing it.
+    """
+
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super().__init__(
+            "; ".join(
+                f"{name} found in multiple packs: {', '.join(str(search_dir) for search_dir in search_dirs)}"
+                for name, search_dirs in sorted(conflicts.items())
+            )
+        )
 
 
 class MultipleMatchingAssets(Exception):
     pass
 
 
+class CompressionFailed(Exception):
+    pass
+
+
+class CompressionExecutor(Enum):
+    Thread = "thread"
+    Process = "process"
+
+
 KNOWN_ASSET_NAMES = {
     Path(path.decode()).name: path.decode()
     for path in KNOWN_ASSETS
 }
 
 
-def get_files_from_search_dir(mods_dir, search_dir):
+def get_files_from_search_dir(mods_dir, search_dir, scan_index=None):
     out_files = {}
+    if scan_index is None:
+        scan_index = ScanIndex()
 
-    search_dir = mods_dir / search_dir
-    if not search_dir.exists():
-        return out_files
-
-    for root, dirs, files in os.walk(search_dir, topdown=True):
-        dirs[:] = [d for d in dirs if d not in [".compressed"]]
-
+    search_dir = Path(search_dir)
+    root = os.fspath(mods_dir / search_dir)
+    for dir_path, files in scan_index.walk(root):
+        rel_dir = dir_path[len(root) + 1:]
         for file_ in files:
             real_name = file_
-            if Path(file_).suffix == ".png":
-                real_name = str(Path(file_).with_suffix(".DDS"))
+            stem, suffix = os.path.splitext(file_)
+            if suffix == ".png":
+                real_name = stem + ".DDS"
 
             if real_name not in KNOWN_ASSET_NAMES:
                 continue
 
             if file_ in out_files:
                 MultipleMatchingAssets(f"Found {file_} multiple times in {search_dir}")
-            out_files[file_] = (
-                search_dir.relative_to(mods_dir),
-                (Path(root) / file_).relative_to(search_dir)
-            )
+            out_files[file_] = (search_dir, Path(rel_dir, file_))
 
     return out_files
 
 
+@dataclass
+class OverlayLayer:
+    search_dir: Path
+    priority: int
+    order: int
+    # File name to its path relative to `search_dir`.
+    files: dict
+
+
+class Overlay:
+    """Search dirs stacked over each other to decide which file provides each asset.
+
+    Every layer is scanned once when it is added. For each file name the
+    layer with the highest priority wins. Ties go to the layer added first
+    or last for `ResolutionPolicy.FirstWins` and `LastWins`; with
+    `RaiseError` they are recorded in `conflicts`. Adding or removing a
+    layer only re-resolves the names that layer provides.
+    """
+
+    def __init__(self, mods_dir, resolution_policy=ResolutionPolicy.RaiseError, scan_index=None):
+        self.mods_dir = Path(mods_dir)
+        self.resolution_policy = resolution_policy
+        self.scan_index = scan_index if scan_index is not None else ScanIndex()
+        self.layers = {}
+        self.providers = defaultdict(list)
+        self.winners = {}
+        self.conflicts = {}
+        self._next_order = 0
+
+    @classmethod
+    def from_search_dirs(
+        cls, mods_dir, search_dirs, resolution_policy=ResolutionPolicy.RaiseError,
+        priorities=None, scan_index=None
+    ):
+        """Stack `search_dirs` in order. `priorities` maps search dirs to their priority."""
+        overlay = cls(mods_dir, resolution_policy, scan_index)
+        priorities = priorities or {}
+        for search_dir in search_dirs:
+            overlay.add_layer(search_dir, priorities.get(search_dir, 0))
+        return overlay
+
+    def add_layer(self, search_dir, priority=0, order=None):
+        """Scan `search_dir` and stack it on top of the layers of the same priority.
+
+        `order` places it among those layers instead; by default it goes last.
+        """
+        search_dir = Path(search_dir)
+        if search_dir in self.layers:
+            self.remove_layer(search_dir)
+
+        files = {
+            file_: path
+            for file_, (_, path) in get_files_from_search_dir(
+                self.mods_dir, search_dir, self.scan_index
+            ).items()
+        }
+        if order is None:
+            order = self._next_order
+            self._next_order += 1
+        layer = OverlayLayer(search_dir, priority, order, files)
+        self.layers[search_dir] = layer
+
+        for file_ in files:
+            self.providers[file_].append(layer)
+            self._resolve(file_)
+
+    def remove_layer(self, search_dir):
+        layer = self.layers.pop(Path(search_dir))
+        for file_ in layer.files:
+            self.providers[file_].remove(layer)
+            if not self.providers[file_]:
+                del self.providers[file_]
+            self._resolve(file_)
+
+    def refresh_layer(self, search_dir):
+        """Rescan a layer whose files changed, keeping its place in the stack."""
+        layer = self.layers[Path(search_dir)]
+        self.add_layer(layer.search_dir, layer.priority, layer.order)
+
+    def winner(self, file_):
+        """`(search_dir, path)` of the file providing `file_`, or None."""
+        layer = self.winners.get(file_)
+        if layer is None:
+            return None
+        return layer.search_dir, layer.files[file_]
+
+    def _resolve(self, file_):
+        self.winners.pop(file_, None)
+        self.conflicts.pop(file_, None)
+
+        layers = self.providers.get(file_)
+        if not layers:
+            return
+
+        top = max(layer.priority for layer in layers)
+        tied = sorted(
+            (layer for layer in layers if layer.priority == top),
+            key=lambda layer: layer.order,
+        )
+        if len(tied) >= 2 and self.resolution_policy == ResolutionPolicy.RaiseError:
+            self.conflicts[file_] = [layer.search_dir for layer in tied]
+        if self.resolution_policy == ResolutionPolicy.LastWins:
+            self.winners[file_] = tied[-1]
+        else:
+            self.winners[file_] = tied[0]
+
+
 def to_dds(img):
     img = img.convert("RGBA")
 
@@ -365,18 +1107,69 @@ def to_dds(img):
     data += pack("<4I", caps, caps2, caps3, caps4)
     data += pack("<I", 0)  # reserved
 
-    data += bytes(
-        (
-            byte if rgba[3] != 0 else 0
-        )  # Hack to force all transparent pixels to be (0, 0, 0, 0)
-           # instead of (255, 255, 255, 0)
-        for rgba in img.getdata()
-        for byte in rgba
-    )
+    pixels = np.array(img, dtype=np.uint8).reshape(height, width, 4)
+    # Hack to force all transparent pixels to be (0, 0, 0, 0)
+    # instead of (255, 255, 255, 0)
+    pixels[pixels[..., 3] == 0] = 0
+    data += pixels.tobytes()
 
     return data
 
 
+# Masks of the channel stored in each byte of a pixel, as the game's DDS
+# headers describe them.
+_DDS_BYTE_MASKS = (0xFF000000, 0x00FF0000, 0x0000FF00, 0x000000FF)
+
+
+def decode_dds(data):
+    """Decode the game's uncompressed 32 bit DDS images to an RGBA `Image`.
+
+    The game stores its masks byte swapped, which Pillow's DDS plugin reads
+    with the wrong channel order. Headers this doesn't handle are decoded by
+    Pillow with its raw mode reversed, which accounts for the same swap.
+    """
+    if len(data) >= 128 and data[:4] == b"DDS ":
+        header_size, _, height, width = unpack_from("<4I", data, 4)
+        pfflags, _, bitcount = unpack_from("<I4sI", data, 80)
+        masks = unpack_from("<4I", data, 92)
+        size = width * height * 4
+        if (
+            header_size == 124
+            and pfflags == 0x41
+            and bitcount == 32
+            and sorted(masks) == sorted(_DDS_BYTE_MASKS)
+            and len(data) >= 128 + size
+        ):
+            pixels = np.frombuffer(data, dtype=np.uint8, count=size, offset=128)
+            pixels = pixels.reshape(height, width, 4)
+            order = [_DDS_BYTE_MASKS.index(mask) for mask in masks]
+            return Image.fromarray(np.ascontiguousarray(pixels[..., order]), "RGBA")
+
+    image = Image.open(io.BytesIO(data))
+    # Swap byte order to read correct endianness
+    image.tile[0] = image.tile[0][:-1] + ((image.tile[0][-1][0][::-1], 0, 1),)
+    image.load()
+    return image
+
+
+def dds_to_png(data, compress_level=None):
+    """Convert a DDS asset to PNG bytes.
+
+    `compress_level` is the zlib level from 0 to 9, see
+    `PNG_FAST_COMPRESS_LEVEL`. None uses Pillow's default.
+    """
+    options = {} if compress_level is None else {"compress_level": compress_level}
+    png_data = io.BytesIO()
+    decode_dds(data).save(png_data, format="PNG", **options)
+    return png_data.getvalue()
+
+
+def png_cache_tag(compress_level=None):
+    """Tag of `dds_to_png` results in a `CompressionCache`."""
+    level = "default" if compress_level is None else compress_level
+    return f"png{PNG_CONVERSION_VERSION}-{level}.png"
+
+
 @dataclass
 class AssetBundle:
     def __init__(self, asset_datas):
@@ -388,15 +1181,27 @@ class AssetBundle:
     @classmethod
     def from_dirs(
         cls, asset_store, mods_dir, search_dirs, fallback_dir,
-        resolution_policy=ResolutionPolicy.RaiseError
+        resolution_policy=ResolutionPolicy.RaiseError, manifest=None, scan_index=None,
+        overlay=None
     ):
+        """Resolve every asset of `asset_store` to a file in `search_dirs` or `fallback_dir`.
+
+        Pass the same `scan_index` to repeated calls to only list directories
+        that changed since the last one. An `Overlay` that is kept up to date
+        can be passed instead of `search_dirs` and `resolution_policy`, which
+        skips scanning the search dirs altogether.
+
+        Raises `FileConflict` with every conflicting asset at once.
+        """
+        if overlay is None:
+            overlay = Overlay.from_search_dirs(
+                mods_dir, search_dirs, resolution_policy, scan_index=scan_index
+            )
+        scan_index = overlay.scan_index
+        scan_index.refresh(mods_dir / fallback_dir)
 
-        pack_assets = defaultdict(list)
         asset_datas = {}
-
-        for search_dir in search_dirs:
-            for (file_, file_paths) in get_files_from_search_dir(mods_dir, search_dir).items():
-                pack_assets[file_].append(file_paths)
+        conflicts = {}
 
         for asset in asset_store.assets:
             if asset.filename is None:
@@ -404,44 +1209,303 @@ class AssetBundle:
             filename = Path(asset.filename.decode())
             if filename.suffix == ".DDS" and asset.filename not in IMAGES_DONT_CONVERT:
                 filename = filename.with_suffix(".png")
-            assets = pack_assets.get(filename.name)
 
-            if not assets:
+            if filename.name in overlay.conflicts:
+                conflicts[filename.name] = overlay.conflicts[filename.name]
+                continue
+
+            winner = overlay.winner(filename.name)
+            if winner is None:
                 file_path = mods_dir / fallback_dir / filename
-                if not file_path.exists():
+                if not scan_index.contains(file_path):
                     raise MissingAsset(f"Didn't find an asset for {file_path}")
 
                 asset_datas[str(Path(asset.filename.decode()).name)] = AssetData(
-                    mods_dir, fallback_dir, filename, asset
+                    mods_dir, fallback_dir, filename, asset,
+                    manifest_entry=manifest and manifest.get(fallback_dir / filename),
                 )
                 continue
 
-            if resolution_policy == ResolutionPolicy.RaiseError and len(assets) >= 2:
-                raise FileConflict(
-                    f"{filename} found in multiple packs: {', '.join(assets)}"
-                )
-
-            idx = 0
-            if resolution_policy == ResolutionPolicy.FirstWins:
-                idx = 0
-            elif resolution_policy == ResolutionPolicy.LastWins:
-                idx = -1
-
-            search_dir, filename_ = assets[idx]
+            search_dir, filename_ = winner
             asset_datas[str(Path(asset.filename.decode()).name)] = AssetData(
-                mods_dir, search_dir, filename_, asset
+                mods_dir, search_dir, filename_, asset,
+                manifest_entry=manifest and manifest.get(search_dir / filename_),
             )
 
+        if conflicts:
+            raise FileConflict(conflicts)
+
         return cls(asset_datas)
 
-    def compress(self, compression_level=DEFAULT_COMPRESSION_LEVEL):
-        pool = ThreadPoolExecutor()
-        futures = [
-            pool.submit(asset_data.compress, compression_level)
+    def update_manifest(self, manifest):
+        """Record the manifest entries of every asset in `manifest`."""
+        for asset_data in self.asset_datas.values():
+            if asset_data.manifest_entry is not None:
+                manifest.set(asset_data.path / asset_data.filename, asset_data.manifest_entry)
+
+    def planned_sizes(self, cache, compression_level=DEFAULT_COMPRESSION_LEVEL, **compress_options):
+        """Map each source file path to the size its payload will have, writing nothing.
+
+        Up to date compressed files are reused. Assets that need compressing
+        are looked up in `cache` and only compressed in memory on a miss,
+        see `schedule_compression`, which gets any other keyword arguments.
+        """
+        sizes = {}
+        jobs = []
+        for asset_data in self.asset_datas.values():
+            if asset_data.needs_compression():
+                jobs.append(asset_data)
+            else:
+                sizes[asset_data.file_path] = asset_data.get_data_size()
+
+        task = partial(cache.reader().compress, level=compression_level)
+        for asset_data, result in schedule_compression(jobs, task, compression_level, **compress_options):
+            sizes[asset_data.file_path] = result.size
+        return sizes
+
+    def fit_to_size(self, asset_store, cache, levels=FIT_COMPRESSION_LEVELS, **compress_options):
+        """Pick a compression level per asset so the layout fits the original region.
+
+        Assets with an up to date compressed file (e.g. unmodified extracted
+        assets) keep it, unless the layout doesn't fit at first, see
+        `shrink_compressed`. Every other encrypted asset starts at the fastest
+        of `levels`, then the asset with the most bytes saved per CPU second
+        for its next level is raised, one step at a time, until the layout fits.
+        Every (content, level) result comes from `cache`, so repeating a
+        search costs nothing. Chosen payloads are used straight from the cache.
+        A read only `cache` writes nothing, but the payloads can't be packed.
+        Every round of compression is run by `schedule_compression`, which
+        gets any other keyword arguments.
+
+        Returns a mapping of source file path to payload size.
+        """
+        budget = asset_store.total_size + 8
+        tunable = [
+            asset_data for asset_data in self.asset_datas.values()
+            if asset_data.needs_compression()
+        ]
+
+        level_index = {}
+        current = {}
+        upgrades = {}
+        shrunk = None
+
+        def compress(asset_datas, level):
+            task = partial(cache.compress, level=level)
+            return schedule_compression(asset_datas, task, level, **compress_options)
+
+        def data_size(asset_data):
+            if asset_data.file_path in current:
+                return current[asset_data.file_path].size
+            if shrunk is not None and asset_data.file_path in shrunk:
+                return shrunk[asset_data.file_path]
+            return asset_data.get_data_size()
+
+        def saving_rate(asset_data):
+            path = asset_data.file_path
+            saved = current[path].size - upgrades[path].size
+            return saved / max(upgrades[path].seconds, 1e-6)
+
+        # Hash every source once up front. `AssetData.content_digest` keeps
+        # the digest, also in the copies worker processes are sent.
+        with ThreadPoolExecutor() as pool:
+            list(pool.map(AssetData.content_digest, tunable))
+
+        for asset_data, result in compress(tunable, levels[0]):
+            level_index[asset_data.file_path] = 0
+            current[asset_data.file_path] = result
+
+        while True:
+            _, end = asset_store.placements(self, data_size)
+            size = end - asset_store.DATA_OFFSET + 8
+            if size <= budget:
+                break
+            if shrunk is None:
+                shrunk = self.shrink_compressed(cache, **compress_options)
+                continue
+
+            raisable = [
+                asset_data for asset_data in tunable
+                if level_index[asset_data.file_path] + 1 < len(levels)
+            ]
+            if not raisable:
+                logging.warning(
+                    "Assets are %d bytes too large even at compression level %d",
+                    size - budget, levels[-1],
+                )
+                break
+
+            missing = defaultdict(list)
+            for asset_data in raisable:
+                if asset_data.file_path not in upgrades:
+                    missing[levels[level_index[asset_data.file_path] + 1]].append(asset_data)
+            for level, asset_datas in sorted(missing.items()):
+                for asset_data, result in compress(asset_datas, level):
+                    upgrades[asset_data.file_path] = result
+
+            best = max(raisable, key=saving_rate)
+            path = best.file_path
+            level_index[path] += 1
+            logging.info(
+                "Raising %s to compression level %d (%d -> %d bytes)",
+                best.filename, levels[level_index[path]], current[path].size, upgrades[path].size,
+            )
+            if upgrades[path].size < current[path].size:
+                current[path] = upgrades[path]
+            del upgrades[path]
+
+        for asset_data in tunable:
+            asset_data.payload_path = current[asset_data.file_path].path
+
+        return {
+            asset_data.file_path: data_size(asset_data)
             for asset_data in self.asset_datas.values()
+        }
+
+    def shrink_compressed(
+        self, cache, compression_level=DEFAULT_COMPRESSION_LEVEL, dry_run=False, **compress_options
+    ):
+        """Recompress up to date compressed payloads at `compression_level`.
+
+        Extraction keeps the game's compressed payloads, which are larger than
+        they need to be. When the assets don't fit this wins back the room:
+        the payload recompressed through `cache` is packed instead wherever
+        it is smaller. Assets that need compressing are left alone. With
+        `dry_run` nothing is written and payloads missing from `cache` are
+        only compressed in memory to learn their size. Any other keyword
+        arguments are passed to `schedule_compression`.
+
+        Returns a mapping of source file path to payload size.
+        """
+        candidates = [
+            asset_data for asset_data in self.asset_datas.values()
+            if asset_data.asset.encrypted and not asset_data.needs_compression()
+        ]
+        logging.info("Assets don't fit, recompressing %d assets...", len(candidates))
+
+        if dry_run:
+            cache = cache.reader()
+        task = partial(AssetData.recompress, cache=cache, compression_level=compression_level)
+
+        sizes = {}
+        results = schedule_compression(candidates, task, compression_level, **compress_options)
+        for asset_data, result in results:
+            size = asset_data.get_data_size()
+            if result.size < size:
+                # A read only cache has no file to pack, only the size.
+                if result.path is not None:
+                    asset_data.payload_path = result.path
+                size = result.size
+            sizes[asset_data.file_path] = size
+        return sizes
+
+    def compress(self, compression_level=DEFAULT_COMPRESSION_LEVEL, cache=None, **compress_options):
+        """Compress every asset that needs it, see `schedule_compression`.
+
+        Results are shared through `cache` when one is given, see
+        `AssetData.compress`. What the compression changes on an `AssetData`
+        is applied here as well, since with `CompressionExecutor.Process` it
+        happens to a copy.
+        """
+        jobs = [
+            asset_data for asset_data in self.asset_datas.values()
             if asset_data.needs_compression()
         ]
-        wait(futures, timeout=300)
+        task = partial(AssetData.compress, compression_level=compression_level, cache=cache)
+        for asset_data, entry in schedule_compression(jobs, task, compression_level, **compress_options):
+            asset_data.payload_path = None
+            asset_data.manifest_entry = entry
+
+
+def schedule_compression(
+    jobs, task, compression_level, executor=CompressionExecutor.Thread, max_workers=None,
+    progress=None
+):
+    """Run `task(asset_data)` for every `AssetData` in `jobs`, largest first.
+
+    Yields `(asset_data, result)` as tasks complete. `executor` picks
+    between a thread pool and a process pool (better for PNG conversion,
+    which holds the GIL). The number of workers is bounded by
+    `max_workers`, the number of cores and the memory available for
+    compressing the largest asset at `compression_level`. The first failure
+    cancels the jobs that haven't started and is raised as
+    `CompressionFailed`. `progress` is called with `(done, total,
+    asset_data)` after each asset.
+    """
+    if not jobs:
+        return
+
+    sizes = {asset_data.file_path: asset_data.estimated_source_size() for asset_data in jobs}
+    jobs = sorted(jobs, key=lambda asset_data: sizes[asset_data.file_path], reverse=True)
+    workers = compression_workers(
+        len(jobs), sizes[jobs[0].file_path], compression_level, max_workers
+    )
+
+    if executor == CompressionExecutor.Process:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    with pool:
+        futures = {pool.submit(task, asset_data): asset_data for asset_data in jobs}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                asset_data = futures[future]
+                try:
+                    result = future.result()
+                except Exception as err:
+                    raise CompressionFailed(
+                        f"Failed to compress {asset_data.file_path}: {err}"
+                    ) from err
+                yield asset_data, result
+                if progress is not None:
+                    progress(done, len(jobs), asset_data)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+def available_memory():
+    """Bytes of memory available to new work, or None where that can't be found out.
+
+    On Linux this is `MemAvailable`, which unlike the free memory counts the
+    page cache that can be reclaimed. Elsewhere it is the total physical
+    memory.
+    """
+    try:
+        with open("/proc/meminfo", "r") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def compression_workers(jobs, largest_size, compression_level, max_workers=None):
+    """Number of workers to compress `jobs` assets with.
+
+    Bounded by the number of cores and by how many copies of the largest
+    job's working set (its data, the compressed output and the zstd
+    context) fit in the memory that is available, see `available_memory`.
+    """
+    workers = min(max_workers or os.cpu_count() or 1, jobs)
+
+    memory = available_memory()
+    if memory is not None:
+        params = zstd.ZstdCompressionParameters.from_level(
+            compression_level, source_size=largest_size
+        )
+        per_worker = params.estimated_compression_context_size() + 3 * largest_size
+        workers = min(workers, memory // per_worker)
+
+    return max(1, workers)
+
 
 @dataclass
 class AssetData:
@@ -449,6 +1513,13 @@ class AssetData:
     path: Path
     filename: str
     asset: Asset
+    # Compressed payload to pack instead of `compressed_path`, e.g. an entry
+    # of the compression cache picked by `AssetBundle.fit_to_size`.
+    payload_path: Path = None
+    # What the manifest knows about `compressed_path`, see `needs_compression`.
+    manifest_entry: ManifestEntry = None
+    # (size, mtime_ns, digest) of the last time the source was hashed.
+    digest_stat: tuple = field(default=None, repr=False)
 
     def md5sum_of_file(self):
         with self.file_path.open("rb") as file_:
@@ -459,6 +1530,17 @@ class AssetData:
                 chunk = file_.read(8192)
             return md5sum.hexdigest().encode()
 
+    def content_digest(self, stat=None):
+        """Digest of the source file, only read again once its stat changes."""
+        if stat is None:
+            stat = self.file_path.stat()
+        if self.digest_stat is not None and self.digest_stat[:2] == (stat.st_size, stat.st_mtime_ns):
+            return self.digest_stat[2]
+
+        digest = file_digest(self.file_path)
+        self.digest_stat = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
     @property
     def real_suffix(self):
         if self.filename.suffix == ".png" and self.asset.filename not in IMAGES_DONT_CONVERT:
@@ -483,61 +1565,136 @@ class AssetData:
 
     @property
     def md5sum_path(self):
+        # Only written by older versions, see `needs_compression`.
         return self.mods_dir / ".compressed" / self.path / self.md5sum_name
 
     def needs_compression(self):
+        """Check whether `compressed_path` is missing or stale.
+
+        When the source's size and mtime match `manifest_entry` nothing is
+        read. Otherwise the source is hashed and, if only its stat changed,
+        `manifest_entry` is refreshed.
+        """
         if not self.asset.encrypted:
             return False
 
-        if not self.md5sum_path.exists():
+        try:
+            stat = self.file_path.stat()
+            compressed_size = self.compressed_path.stat().st_size
+        except FileNotFoundError:
             return True
 
-        if not self.compressed_path.exists():
-            return True
+        entry = self.manifest_entry
+        if entry is not None:
+            if entry.compressed_size != compressed_size:
+                return True
+            if entry.matches_stat(stat):
+                return False
+            if self.content_digest(stat) != entry.digest:
+                return True
+            self.manifest_entry = replace(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            return False
 
-        md5sum = self.md5sum_of_file()
+        # Compressed by an older version that kept an MD5 in a sidecar file.
+        if not self.md5sum_path.exists():
+            return True
         with self.md5sum_path.open("rb") as md5sum_file:
             stored_md5sum = md5sum_file.read().strip()
-        if md5sum != stored_md5sum:
+        if self.md5sum_of_file() != stored_md5sum:
             return True
 
+        self.manifest_entry = ManifestEntry.for_files(
+            stat, self.content_digest(stat), self.mods_dir, self.compressed_path
+        )
         return False
 
-    def compress(self, compression_level=DEFAULT_COMPRESSION_LEVEL):
+    def compress(self, compression_level=DEFAULT_COMPRESSION_LEVEL, cache=None):
+        """Write the compressed payload and return its `ManifestEntry`.
+
+        With a `CompressionCache` the payload is taken from it when the same
+        content was compressed at this level before, and linked (or copied)
+        into place rather than written again.
+        """
         if not self.asset.encrypted:
-            return
+            return None
 
         self.compressed_path.parent.mkdir(parents=True, exist_ok=True)
-        self.md5sum_path.parent.mkdir(parents=True, exist_ok=True)
 
+        stat = self.file_path.stat()
+        digest = self.content_digest(stat)
+
+        logging.info("Compressing %s...", self.filename)
+        if cache is not None:
+            cached = cache.compress(self, compression_level, digest=digest)
+            link_or_copy(cached.path, self.compressed_path)
+        else:
+            cctx = zstd.ZstdCompressor(level=compression_level)
+            atomic_write(self.compressed_path, cctx.compress(self.source_data()))
+
+        if self.md5sum_path.exists():
+            self.md5sum_path.unlink()
+
+        self.payload_path = None
+        self.manifest_entry = ManifestEntry.for_files(
+            stat, digest, self.mods_dir, self.compressed_path
+        )
+        return self.manifest_entry
+
+    def recompress(self, cache, compression_level=DEFAULT_COMPRESSION_LEVEL):
+        """Payload of this up to date asset compressed at `compression_level` by `cache`.
+
+        Only for assets that `needs_compression` is False for. The digest is taken
+        from `manifest_entry`, so the source isn't read again on a hit.
+        """
+        return cache.compress(self, compression_level, digest=self.manifest_entry.digest)
+
+    def payload_signature(self):
+        """Identifies the payload `get_data` returns without reading it, or None.
+
+        Encrypted payloads are a content addressed cache entry or the
+        compressed file of a source whose digest the manifest knows.
+        Unencrypted ones are identified by their source's path, size and mtime.
+        """
+        if not self.asset.encrypted:
+            stat = self.file_path.stat()
+            return f"file:{self.file_path.as_posix()}:{stat.st_size}:{stat.st_mtime_ns}"
+        if self.payload_path is not None:
+            return f"cache:{self.payload_path.name}"
+        if self.manifest_entry is not None:
+            return f"compressed:{self.manifest_entry.digest}:{self.manifest_entry.compressed_size}"
+        return None
+
+    def source_data(self):
+        """Contents to compress for this asset, converting PNGs back to DDS."""
         if self.file_path.suffix == ".png":
             logging.info('Converting image "%s" to DDS', self.filename)
             with Image.open(self.file_path) as img:
-                data = to_dds(img)
-        else:
-            with open(self.file_path, "rb") as asset_file:
-                data = asset_file.read()
+                return to_dds(img)
 
-        md5sum = self.md5sum_of_file()
-        with self.md5sum_path.open("wb") as md5sum_file:
-            md5sum_file.write(md5sum)
+        with open(self.file_path, "rb") as asset_file:
+            return asset_file.read()
 
-        logging.info("Compressing %s...", self.filename)
-        cctx = zstd.ZstdCompressor(level=compression_level)
-        data = cctx.compress(data)
-        with open(self.compressed_path, "wb") as compressed_file:
-            compressed_file.write(data)
+    def estimated_source_size(self):
+        """Size of the data that will be compressed, without converting anything."""
+        if self.file_path.suffix == ".png":
+            try:
+                with Image.open(self.file_path) as img:
+                    return img.width * img.height * 4 + 128
+            except OSError:
+                # Broken images fail properly once they are compressed.
+                pass
+        return self.file_path.stat().st_size
 
     def get_data_size(self):
         if self.asset.encrypted:
-            path = self.compressed_path
+            path = self.payload_path or self.compressed_path
         else:
             path = self.file_path
         return path.stat().st_size
 
     def get_data(self):
         if self.asset.encrypted:
-            path = self.compressed_path
+            path = self.payload_path or self.compressed_path
         else:
             path = self.file_path
 
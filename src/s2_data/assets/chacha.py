@@ -1,5 +1,6 @@
 from struct import pack, unpack
 
+import numpy as np
 import zstandard as zstd
 
 DEFAULT_COMPRESSION_LEVEL = 20
@@ -60,6 +61,19 @@ def sxor(x, y):
     return bytes(a ^ b for a, b in zip(x, y))
 
 
+def xor_blocks(data, block):
+    """XOR every whole 64-byte block of `data` with `block`.
+
+    Equivalent to `sxor(data, block * (len(data) // 0x40))` but done as
+    uint64 words with numpy so multi-megabyte assets don't go through the
+    interpreter a byte at a time. Any trailing partial block is ignored.
+    """
+    blocks = len(data) // 0x40
+    words = np.frombuffer(data, dtype="<u8", count=blocks * 8)
+    key_words = np.frombuffer(block, dtype="<u8")
+    return (words.reshape(blocks, 8) ^ key_words).tobytes()
+
+
 def s_to_w(s):
     return list(unpack(b"<" + (b"I" * (len(s) // 4)), s))
 
@@ -138,7 +152,8 @@ class Key:
         self.key ^= v4 ^ ((v4 ^ (v4 >> 28)) >> 23)
 
 
-def chacha(name, data, key):
+def chacha_key(name, size, key):
+    """Derive the 64 byte keystream block used to encrypt `size` bytes of `name`."""
     # Untweaked key begins as half-advanced `key`
     h = two_rounds(pack(b"<QQQQQQQQ", key, len(name), 0, 0, 0, 0, 0, 0))
 
@@ -150,17 +165,176 @@ def chacha(name, data, key):
     # Add the tweaked key and its advancement, then advance by four round pairs.
     tmp = add_qwords(h, quad_rounds(h))
     tmp = s_to_q(tmp)
-    key = quad_rounds(q_to_s([tmp[0] ^ key + len(data)] + tmp[1:]))
+    nonce = (key + size) & 0xFFFFFFFFFFFFFFFF
+    return quad_rounds(q_to_s([tmp[0] ^ nonce] + tmp[1:]))
+
 
+def apply_keystream(data, key):
     # NOTE: This appears to be an implementation mistake on the Spelunky 2 dev's part
     # They generate a quad_round advanced version of (nonce'd key), but then they
     # xor with the untweaked key instead of the tweaked key...
     out = b""
     if len(data) >= 0x40:
         blocks = len(data) // 0x40
-        out += sxor(data, key[::-1] * blocks)
+        out += xor_blocks(data, key[::-1])
         data = data[blocks * 0x40 :]
     if len(data) > 0:
         out += sxor(data, key[: len(data)][::-1])
 
     return out
+
+
+def keystream_at(key, size, start, length):
+    """Keystream bytes `apply_keystream` uses for `data[start:start + length]`.
+
+    `size` is the length of the whole payload, which decides where the
+    trailing partial block (keyed differently) begins. Returned as a uint8
+    numpy array so that chunks of a payload can be decrypted independently.
+    """
+    full = size // 0x40 * 0x40
+    out = np.empty(length, dtype=np.uint8)
+
+    in_blocks = max(0, min(start + length, full) - start)
+    if in_blocks:
+        block = np.frombuffer(key[::-1], dtype=np.uint8)
+        out[:in_blocks] = np.resize(np.roll(block, -(start % 0x40)), in_blocks)
+
+    if length > in_blocks:
+        tail = np.frombuffer(key[: size - full][::-1], dtype=np.uint8)
+        tail_start = max(start, full) - full
+        out[in_blocks:] = tail[tail_start : tail_start + length - in_blocks]
+
+    return out
+
+
+def chacha(name, data, key, keystream=None):
+    """Encrypt or decrypt `data`.
+
+    `keystream` may be passed in when it was already derived, e.g. by
+    `chacha_keys` for a whole batch of assets.
+    """
+    if keystream is None:
+        keystream = chacha_key(name, len(data), key)
+    return apply_keystream(data, keystream)
+
+
+# Batched engine
+#
+# The functions below run the same rounds as `quarter_round`/`round_pair` on
+# many independent states at once. Lanes are stored as a (16, N) uint32 array
+# so that each word of every state is a contiguous row.
+
+def _lanes_rotate_left(x, bits):
+    return (x << np.uint32(bits)) | (x >> np.uint32(32 - bits))
+
+
+def _lanes_quarter_round(w, a, b, c, d):
+    w[a] += w[b]
+    w[d] ^= w[a]
+    w[d] = _lanes_rotate_left(w[d], 16)
+    w[c] += w[d]
+    w[b] ^= w[c]
+    w[b] = _lanes_rotate_left(w[b], 12)
+    w[a] += w[b]
+    w[d] ^= w[a]
+    w[d] = _lanes_rotate_left(w[d], 8)
+    w[c] += w[d]
+    w[b] ^= w[c]
+    w[b] = _lanes_rotate_left(w[b], 7)
+
+
+def _lanes_round_pair(w):
+    _lanes_quarter_round(w, 0, 4, 8, 12)
+    _lanes_quarter_round(w, 1, 5, 9, 13)
+    _lanes_quarter_round(w, 2, 6, 10, 14)
+    _lanes_quarter_round(w, 3, 7, 11, 15)
+    _lanes_quarter_round(w, 0, 5, 10, 15)
+    _lanes_quarter_round(w, 1, 6, 11, 12)
+    _lanes_quarter_round(w, 2, 7, 8, 13)
+    _lanes_quarter_round(w, 3, 4, 9, 14)
+
+
+def lanes_two_rounds(w):
+    w = w.copy()
+    _lanes_round_pair(w)
+    _lanes_round_pair(w)
+    return w
+
+
+def lanes_quad_rounds(w):
+    w = w.copy()
+    _lanes_round_pair(w)
+    _lanes_round_pair(w)
+    _lanes_round_pair(w)
+    _lanes_round_pair(w)
+    return w
+
+
+def s_to_lanes(s):
+    """Convert an (N, 64) uint8 array of states to (16, N) lanes."""
+    return s.view("<u4").T.astype(np.uint32)
+
+
+def lanes_to_s(w):
+    """Convert (16, N) lanes back to an (N, 64) uint8 array of states."""
+    return np.ascontiguousarray(w.T, dtype="<u4").view(np.uint8)
+
+
+def _lanes_tweaked(names, key):
+    """Batched equivalent of the key tweak shared by `filename_hash` and `chacha_key`."""
+    q = np.zeros((len(names), 8), dtype="<u8")
+    q[:, 0] = key
+    q[:, 1] = [len(name) for name in names]
+    w = lanes_two_rounds(s_to_lanes(q.view(np.uint8)))
+
+    # Mix the names in 64 bytes at a time. Names that have run out of
+    # partials must not be advanced any further.
+    for i in range(0, max(len(name) for name in names), 0x40):
+        partials = np.zeros((len(names), 0x40), dtype=np.uint8)
+        active = np.zeros(len(names), dtype=bool)
+        for lane, name in enumerate(names):
+            partial = name[i : i + 0x40]
+            if partial:
+                partials[lane, : len(partial)] = np.frombuffer(partial[::-1], dtype=np.uint8)
+                active[lane] = True
+        mixed = lanes_quad_rounds(s_to_lanes(lanes_to_s(w) ^ partials))
+        w = np.where(active, mixed, w)
+
+    return w
+
+
+def _lanes_advance(w, nonces):
+    tmp = lanes_to_s(w).view("<u8") + lanes_to_s(lanes_quad_rounds(w)).view("<u8")
+    tmp[:, 0] ^= nonces
+    return lanes_to_s(lanes_quad_rounds(s_to_lanes(tmp.view(np.uint8))))
+
+
+def filename_hashes(names, key):
+    """Batched `filename_hash` for every name in `names`."""
+    names = list(names)
+    if not names:
+        return []
+
+    lengths = np.array([len(name) for name in names], dtype=np.uint64)
+    keys = _lanes_advance(_lanes_tweaked(names, key), lengths)
+
+    hashes = []
+    for name, key_ in zip(names, keys):
+        key_ = key_.tobytes()
+        h = b""
+        for i in range(0, len(name), 0x40):
+            partial = name[i : i + 0x40]
+            h += sxor(partial, key_[: len(partial)][::-1])
+        hashes.append(h)
+    return hashes
+
+
+def chacha_keys(names, key, sizes):
+    """Batched `chacha_key` for every (name, size) pair."""
+    names = list(names)
+    if not names:
+        return []
+
+    nonces = np.array(sizes, dtype=np.uint64) + np.uint64(key)
+    keys = _lanes_advance(_lanes_tweaked(names, key), nonces)
+    return [key_.tobytes() for key_ in keys]
@@ -0,0 +1,209 @@
+"""
+Content-addressed cache of compressed asset payloads.
+
+Entries are keyed by a digest of the source file, the compression level and,
+for images converted back to DDS, the version of that conversion. The same
+source compressed at the same level is therefore only ever compressed once,
+however many times a layout is searched and whichever mods directory or pack
+it comes from.
+
+Images converted from DDS to PNG on extraction are cached the same way,
+keyed by a digest of the decompressed DDS, see `CompressionCache.converted`.
+
+The cache lives in a per-user directory by default and is bounded in size.
+Hits refresh an entry's mtime and `evict` removes the least recently used
+entries once the cache grows past its limit. A read only cache serves hits
+but keeps what it compresses in memory, for dry runs.
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import zstandard as zstd
+
+from .fileio import atomic_write
+
+# Bump whenever `to_dds` changes the bytes it produces for a PNG.
+CONVERSION_VERSION = 1
+# Bump whenever `dds_to_png` changes the bytes it produces for a DDS.
+PNG_CONVERSION_VERSION = 1
+
+CACHE_DIR_ENV = "S2_DATA_CACHE_DIR"
+DEFAULT_CACHE_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+
+def default_cache_dir():
+    """Shared cache directory: `$S2_DATA_CACHE_DIR` or the platform's user cache dir."""
+    if os.environ.get(CACHE_DIR_ENV):
+        return Path(os.environ[CACHE_DIR_ENV])
+
+    if sys.platform == "win32" and os.environ.get("LOCALAPPDATA"):
+        base = Path(os.environ["LOCALAPPDATA"])
+    elif os.environ.get("XDG_CACHE_HOME"):
+        base = Path(os.environ["XDG_CACHE_HOME"])
+    else:
+        base = Path.home() / ".cache"
+    return base / "s2-data" / "compressed"
+
+
+@dataclass
+class CachedCompression:
+    # None for entries a read only cache didn't store.
+    path: Path
+    size: int
+    seconds: float
+
+
+class CompressionCache:
+    def __init__(self, cache_dir=None, max_size=DEFAULT_CACHE_MAX_SIZE, read_only=False):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else default_cache_dir()
+        self.max_size = max_size
+        self.read_only = read_only
+
+    def reader(self):
+        """A read only view of this cache, for dry runs."""
+        if self.read_only:
+            return self
+        return CompressionCache(self.cache_dir, self.max_size, read_only=True)
+
+    def entry_path(self, digest, level, converted):
+        conversion = f"-dds{CONVERSION_VERSION}" if converted else ""
+        return self.cache_dir / digest[:2] / f"{digest}{conversion}-{level}.zst"
+
+    def get(self, digest, level, converted):
+        path = self.entry_path(digest, level, converted)
+        try:
+            with path.with_suffix(".json").open("r") as meta_file:
+                meta = json.load(meta_file)
+            size = path.stat().st_size
+            # Mark the entry as recently used for `evict`.
+            if not self.read_only:
+                os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return CachedCompression(path, size, meta["seconds"])
+
+    def put(self, digest, level, converted, data, seconds):
+        if self.read_only:
+            return CachedCompression(None, len(data), seconds)
+
+        path = self.entry_path(digest, level, converted)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(path, data)
+        atomic_write(path.with_suffix(".json"), json.dumps({"seconds": seconds}).encode())
+        return CachedCompression(path, len(data), seconds)
+
+    def compress(self, asset_data, level, digest=None):
+        """Compressed payload of `asset_data` at `level`, compressing only on a miss.
+
+        `digest` is the source file's `content_digest` if already known.
+        """
+        if digest is None:
+            digest = asset_data.content_digest()
+        converted = asset_data.file_path.suffix == ".png"
+        return self.compress_data(asset_data.source_data, level, digest, converted)
+
+    def compress_data(self, data, level, digest, converted=False):
+        """Like `compress` for the source whose digest is `digest`.
+
+        `data` is the payload to compress, or a function returning it that
+        is only called on a miss. `converted` is set if it is a DDS converted
+        from the PNG `digest` was taken of.
+        """
+        cached = self.get(digest, level, converted)
+        if cached is not None:
+            return cached
+
+        if callable(data):
+            data = data()
+        start = time.perf_counter()
+        data = zstd.ZstdCompressor(level=level).compress(data)
+        return self.put(digest, level, converted, data, time.perf_counter() - start)
+
+    def converted(self, digest, tag, convert):
+        """Bytes returned by `convert()` for the content `digest`, only calling it on a miss.
+
+        `tag` names the conversion and everything that affects its output.
+        """
+        path = self.cache_dir / digest[:2] / f"{digest}-{tag}"
+        try:
+            data = path.read_bytes()
+            if not self.read_only:
+                os.utime(path)
+            return data
+        except FileNotFoundError:
+            pass
+
+        data = convert()
+        if self.read_only:
+            return data
+        path.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(path, data)
+        return data
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in `max_size`.
+
+        Entries also linked into a mods directory's `.compressed` take no
+        space of their own, so they are neither counted nor removed.
+
+        Returns the number of bytes freed.
+        """
+        entries = []
+        total = 0
+        for path in self.cache_dir.glob("*/*"):
+            if path.suffix in (".json", ".tmp"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink > 1:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+            total += stat.st_size
+
+        freed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total - freed <= self.max_size:
+                break
+            for entry_file in (path.with_suffix(".json"), path):
+                try:
+                    entry_file.unlink()
+                except FileNotFoundError:
+                    pass
+            freed += size
+
+        if freed:
+            logging.info("Evicted %d bytes from the compression cache %s", freed, self.cache_dir)
+        return freed
+
+
+def add_cache_arguments(parser):
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory of the compressed asset cache shared by every mods directory."
+            " Defaults to $S2_DATA_CACHE_DIR or the user cache directory."
+        ),
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=int,
+        default=DEFAULT_CACHE_MAX_SIZE // (1024 * 1024),
+        help="Size in MiB above which the least recently used cache entries are removed.",
+    )
+
+
+def get_compression_cache(args, read_only=False):
+    return CompressionCache(
+        args.cache_dir, max_size=args.cache_max_size * 1024 * 1024, read_only=read_only
+    )
@@ -1,12 +1,23 @@
 import argparse
 import binascii
 import logging
-from concurrent.futures import ThreadPoolExecutor, wait
+import re
+import threading
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from dataclasses import dataclass, field
 from pathlib import Path
 
-from .assets import EXTRACTED_DIR, KNOWN_ASSETS, AssetStore
+from .assets import (EXTRACTED_DIR, KNOWN_ASSETS, PNG_FAST_COMPRESS_LEVEL,
+                     TOC_CACHE_DIR, AssetStore, CompressionExecutor,
+                     png_cache_tag)
+from .compression_cache import (CompressionCache, add_cache_arguments,
+                                get_compression_cache)
+from .manifest import ExtractionEntry, Manifest
+from .toc_cache import TocCache
 
 DEFAULT_MODS_DIR = "Mods"
+DEFAULT_MAX_IN_FLIGHT_MB = 256
 
 DIRS = [
     "Data/Fonts",
@@ -14,20 +25,246 @@ DIRS = [
     "Data/Textures/OldTextures"
 ]
 
+# Patterns selected by each `--category`.
+CATEGORIES = {
+    "fonts": ["Data/Fonts/**"],
+    "levels": ["Data/Levels/**"],
+    "textures": ["Data/Textures/**"],
+    "sounds": ["*.bank"],
+    "strings": ["strings*.str"],
+    "shaders": ["*.hlsl"],
+}
 
-def main():
 
-    parser = argparse.ArgumentParser(description="Extract Spelunky 2 Assets.")
-    parser.add_argument("exe", type=argparse.FileType("rb"), help="Path to Spel2.exe")
-    parser.add_argument("--mods-dir", default=DEFAULT_MODS_DIR)
+def glob_regex(pattern):
+    """Compile a glob over asset names to a regex.
 
-    args = parser.parse_args()
+    `*` and `?` don't match `/` while `**` matches any number of directories.
+    Patterns without a `/` match the file name in any directory. Matching
+    ignores case, like the filesystems of the game's platform.
+    """
+    if "/" not in pattern:
+        pattern = f"**/{pattern}"
 
-    mods_dir = Path(args.mods_dir)
+    regex = []
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith("**/", index):
+            regex.append("(?:.*/)?")
+            index += 3
+        elif pattern.startswith("**", index):
+            regex.append(".*")
+            index += 2
+        elif pattern[index] == "*":
+            regex.append("[^/]*")
+            index += 1
+        elif pattern[index] == "?":
+            regex.append("[^/]")
+            index += 1
+        else:
+            regex.append(re.escape(pattern[index]))
+            index += 1
+    return re.compile("".join(regex), re.IGNORECASE)
+
+
+@dataclass
+class AssetSelection:
+    """Which assets to extract.
+
+    An asset is selected if it matches any of the `include` patterns or
+    `categories` (or there are none), has one of the extensions in `types`
+    (or there are none) and matches none of the `exclude` patterns.
+    """
+    include: list = field(default_factory=list)
+    exclude: list = field(default_factory=list)
+    categories: list = field(default_factory=list)
+    types: list = field(default_factory=list)
+    include_regexes: list = field(init=False, repr=False)
+    exclude_regexes: list = field(init=False, repr=False)
+    suffixes: frozenset = field(init=False, repr=False)
+
+    def __post_init__(self):
+        patterns = list(self.include)
+        for category in self.categories:
+            patterns.extend(CATEGORIES[category])
+        self.include_regexes = [glob_regex(pattern) for pattern in patterns]
+        self.exclude_regexes = [glob_regex(pattern) for pattern in self.exclude]
+        self.suffixes = frozenset(f".{type_.lstrip('.').lower()}" for type_ in self.types)
+
+    @property
+    def selects_all(self):
+        return not (self.include_regexes or self.exclude_regexes or self.suffixes)
+
+    def matches(self, filename):
+        if isinstance(filename, bytes):
+            filename = filename.decode()
+        if self.include_regexes and not any(
+            regex.fullmatch(filename) for regex in self.include_regexes
+        ):
+            return False
+        if self.suffixes and Path(filename).suffix.lower() not in self.suffixes:
+            return False
+        return not any(regex.fullmatch(filename) for regex in self.exclude_regexes)
+
+
+class InFlightBudget:
+    """Bounds the payload bytes being worked on at once.
+
+    `acquire` blocks until `size` more bytes fit under `limit`. A payload
+    larger than `limit` is let through once nothing else is in flight.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.in_flight == 0 or self.in_flight + size <= self.limit
+            )
+            self.in_flight += size
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight -= size
+            self.condition.notify_all()
+
+
+class ManifestEntries:
+    """Collects what `Asset.extract` records, to apply to a `Manifest` later.
+
+    Lets extraction in other processes report its manifest entries back.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.extractions = []
+
+    def set(self, source, entry):
+        self.entries.append((source, entry))
+
+    def set_extraction(self, asset_name, entry):
+        self.extractions.append((asset_name, entry))
+
+    def apply(self, manifest):
+        for source, entry in self.entries:
+            manifest.set(source, entry)
+        for asset_name, entry in self.extractions:
+            manifest.set_extraction(asset_name, entry)
+
+
+def extraction_settings(asset, options):
+    """Describes the options that change what extracting `asset` writes."""
+    compression_level = options.get("compression_level")
+    settings = "frame" if compression_level is None else f"zst{compression_level}"
+    if asset.converts_to_png:
+        settings += f"/{png_cache_tag(options.get('png_compress_level'))}"
+    return settings
+
+
+def is_extracted(asset, mods_dir, extracted, source_entry, settings, payload_digest):
+    """Whether the files extracted from `asset` before are still current.
+
+    They are if the payload and settings are the ones recorded in
+    `extracted` and the files are still there, with the size and mtime
+    recorded in `source_entry`.
+    """
+    if extracted is None or extracted != ExtractionEntry(payload_digest, settings):
+        return False
+
+    filepath, compressed_filepath = asset.extract_paths(mods_dir, EXTRACTED_DIR)
+    try:
+        stat = filepath.stat()
+    except FileNotFoundError:
+        return False
+    if source_entry is None or not source_entry.matches_stat(stat):
+        return False
+    return not asset.encrypted or compressed_filepath.exists()
+
+
+def extract_asset(asset_store, asset, mods_dir, key, options, extracted=None, source_entry=None):
+    """Extract `asset`, reading its payload from `asset_store` only now.
+
+    `extracted` and `source_entry` are what the manifest recorded for the
+    asset and its extracted file, if anything. Extraction is skipped when
+    they show the files on disk came from the same payload.
 
+    Returns whether the asset was extracted, and the manifest entries of the
+    written files.
+    """
+    entries = ManifestEntries()
+    name = asset.filename.decode()
+    try:
+        asset_store.load_data(asset)
+        settings = extraction_settings(asset, options)
+        payload_digest = asset.payload_digest(key)
+        if is_extracted(asset, mods_dir, extracted, source_entry, settings, payload_digest):
+            logging.debug("Skipping unchanged %s", name)
+            return False, entries
+
+        logging.info("Extracting %s... ", name)
+        if asset.extract(mods_dir, EXTRACTED_DIR, key, manifest=entries, **options) is not None:
+            entries.set_extraction(name, ExtractionEntry(payload_digest, settings))
+    finally:
+        asset_store.unload_data(asset)
+    return True, entries
+
+
+# Store of each extraction worker process, mapping the exe for itself.
+_worker_store = None
+
+
+def _init_worker(exe_path):
+    global _worker_store  # pylint: disable=global-statement
     logging.basicConfig(format="%(levelname)s - %(message)s", level=logging.INFO)
+    _worker_store = AssetStore(open(exe_path, "rb"))
+    _worker_store.map_exe()
+
+
+def _extract_in_worker(asset, mods_dir, key, options, extracted, source_entry):
+    return extract_asset(_worker_store, asset, mods_dir, key, options, extracted, source_entry)
+
+
+def submit_extraction(pool, asset_store, asset, mods_dir, options, previous):
+    """Submit `extract_asset` for `asset` to `pool`, a thread or worker process pool.
 
-    asset_store = AssetStore.load_from_file(args.exe)
+    `previous` is the `(extracted, source_entry)` the manifest has for it.
+    """
+    if isinstance(pool, ProcessPoolExecutor):
+        # Worker processes are only sent the asset's offsets and read the
+        # payload from their own mapping of the exe.
+        return pool.submit(
+            _extract_in_worker, asset, mods_dir, asset_store.key, options, *previous
+        )
+    return pool.submit(
+        extract_asset, asset_store, asset, mods_dir, asset_store.key, options, *previous
+    )
+
+
+def extract_assets(
+    exe, mods_dir=DEFAULT_MODS_DIR, selection=None, cache=None, toc_cache=None, force=False,
+    compression_level=None, png_compress_level=None, executor=CompressionExecutor.Thread,
+    workers=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT_MB * 1024 * 1024,
+):
+    """Extract the known assets of `exe`, an open Spel2.exe, below `mods_dir`.
+
+    Only the assets matching `selection`, an `AssetSelection`, are read at
+    all. Unless `force` is set, assets unchanged since they were last
+    extracted are skipped, see `extract_asset`. `compression_level` and
+    `png_compress_level` are passed to `Asset.extract`. Assets are extracted
+    in a pool of `workers` threads or processes, with at most
+    `max_in_flight` bytes of payloads read but not yet extracted.
+
+    Returns the sorted names of the assets that were extracted.
+    """
+    mods_dir = Path(mods_dir)
+    asset_store = AssetStore.load_from_file(exe, toc_cache=toc_cache)
+    asset_store.populate_asset_names()
+    if cache is None:
+        cache = CompressionCache()
+    manifest = Manifest.for_mods_dir(mods_dir)
     seen = {}
 
     # Make all directories for extraction and overrides
@@ -37,40 +274,216 @@ def main():
         (mods_dir / EXTRACTED_DIR / dir_).mkdir(parents=True, exist_ok=True)
         (mods_dir / ".compressed" / EXTRACTED_DIR / dir_).mkdir(parents=True, exist_ok=True)
 
+    assets_by_name = {
+        asset.filename: asset
+        for asset in asset_store.assets
+        if asset.filename is not None
+    }
     for filename in KNOWN_ASSETS:
-        asset = asset_store.find_asset(filename)
-        name_hash = asset_store.filename_hash(filename)
+        asset = assets_by_name.get(filename)
         if asset is None:
             logging.warning("Asset %s not found with hash %s...",
                 filename.decode(),
-                binascii.hexlify(name_hash)
+                binascii.hexlify(asset_store.filename_hash(filename))
             )
             continue
 
-        asset.filename = filename
         seen[asset.name_hash] = asset
 
-        Path(filename.decode())
-        asset.load_data(args.exe)
+    selected = [
+        asset for asset in seen.values()
+        if selection is None or selection.matches(asset.filename)
+    ]
+    if selection is not None:
+        logging.info("Extracting %d of %d assets", len(selected), len(seen))
+
+    # Payloads are read by the workers as they get to them, in exe order, and
+    # dropped once extracted. The budget holds back submitting more work.
+    budget = InFlightBudget(max_in_flight)
 
-    def extract_single(asset):
-        try:
-            logging.info("Extracting %s... ", asset.filename.decode())
-            asset.extract(mods_dir, EXTRACTED_DIR, asset_store.key)
-        except Exception:
-            logging.exception("Failed Extraction")
+    options = dict(
+        cache=cache,
+        compression_level=compression_level,
+        png_compress_level=png_compress_level,
+    )
+
+    if CompressionExecutor(executor) == CompressionExecutor.Process:
+        pool = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(exe.name,)
+        )
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    def previous_extraction(asset):
+        if force:
+            return None, None
+        filepath, _ = asset.extract_paths(mods_dir, EXTRACTED_DIR)
+        return (
+            manifest.get_extraction(asset.filename.decode()),
+            manifest.get(filepath.relative_to(mods_dir)),
+        )
+
+    changed = []
+    unchanged = 0
+    with pool:
+        futures = {}
+        for asset in sorted(selected, key=lambda asset: asset.data_offset):
+            budget.acquire(asset.data_size)
+            future = submit_extraction(
+                pool, asset_store, asset, mods_dir, options, previous_extraction(asset)
+            )
+            future.add_done_callback(lambda _, size=asset.data_size: budget.release(size))
+            futures[future] = asset
 
-    pool = ThreadPoolExecutor()
-    futures = [pool.submit(extract_single, asset) for asset in seen.values()]
-    wait(futures, timeout=300)
-    #for asset in seen.values():
-    #    extract_single(asset)
+        for future in as_completed(futures):
+            asset = futures[future]
+            try:
+                extracted, entries = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                logging.error("Failed Extraction of %s", asset.filename.decode(), exc_info=err)
+                continue
+            entries.apply(manifest)
+            if extracted:
+                changed.append(asset.filename.decode())
+            else:
+                unchanged += 1
+    manifest.save()
+    changed.sort()
+
+    if unchanged:
+        logging.info(
+            "Extracted %d changed assets, %d were unchanged since the last extraction",
+            len(changed), unchanged,
+        )
+        for name in changed:
+            logging.info("Changed: %s", name)
 
     for asset in sorted(asset_store.assets, key=lambda a: a.offset):
-        name_hash = asset_store.filename_hash(asset.filename)
         if asset.name_hash not in seen:
             logging.warning("Un-extracted Asset %s", asset)
 
+    asset_store.close()
+    cache.evict()
+    return changed
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Extract Spelunky 2 Assets.")
+    parser.add_argument("exe", type=argparse.FileType("rb"), help="Path to Spel2.exe")
+    parser.add_argument("--mods-dir", default=DEFAULT_MODS_DIR)
+    parser.add_argument(
+        "--no-toc-cache",
+        action="store_true",
+        help="Always re-parse the asset table of contents instead of using the cached copy.",
+    )
+
+    parser.add_argument(
+        "--png-compress-level",
+        type=int,
+        choices=range(10),
+        default=None,
+        help="zlib level (0-9) of the PNGs textures are extracted to. Defaults to Pillow's.",
+    )
+    parser.add_argument(
+        "--fast-png",
+        action="store_const",
+        dest="png_compress_level",
+        const=PNG_FAST_COMPRESS_LEVEL,
+        help="Write larger PNGs much faster.",
+    )
+    parser.add_argument(
+        "--recompress-level",
+        type=int,
+        default=None,
+        help=(
+            "Recompress extracted assets at this zstd level right away. By default the"
+            " game's compressed payloads are kept and only recompressed when packing"
+            " needs the room."
+        ),
+    )
+    parser.add_argument(
+        "--max-in-flight-mb",
+        type=int,
+        default=DEFAULT_MAX_IN_FLIGHT_MB,
+        help="MiB of asset payloads read from the exe but not yet extracted at any time.",
+    )
+    parser.add_argument(
+        "--executor",
+        choices=[executor.value for executor in CompressionExecutor],
+        default=CompressionExecutor.Thread.value,
+        help=(
+            "Extract assets in a pool of threads or of processes, which scales"
+            " with the number of cores."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of assets to extract at once. Defaults to the number of cores.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Extract every asset, even those unchanged since the last extraction.",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help=(
+            "Only extract assets matching this pattern, e.g. 'Data/Levels/**/*.lvl'."
+            " Patterns without a '/' match file names in any directory. Can be passed"
+            " multiple times."
+        ),
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="GLOB",
+        help="Don't extract assets matching this pattern. Can be passed multiple times.",
+    )
+    parser.add_argument(
+        "--category",
+        action="append",
+        default=[],
+        choices=sorted(CATEGORIES),
+        help="Only extract assets of this category. Can be passed multiple times.",
+    )
+    parser.add_argument(
+        "--type",
+        action="append",
+        default=[],
+        dest="types",
+        metavar="EXT",
+        help="Only extract assets with this file extension, e.g. 'lvl' or 'DDS'.",
+    )
+    add_cache_arguments(parser)
+
+    args = parser.parse_args()
+
+    mods_dir = Path(args.mods_dir)
+
+    logging.basicConfig(format="%(levelname)s - %(message)s", level=logging.INFO)
+
+    selection = AssetSelection(args.include, args.exclude, args.category, args.types)
+    extract_assets(
+        args.exe,
+        mods_dir,
+        selection=None if selection.selects_all else selection,
+        cache=get_compression_cache(args),
+        toc_cache=None if args.no_toc_cache else TocCache(mods_dir / TOC_CACHE_DIR),
+        force=args.force,
+        compression_level=args.recompress_level,
+        png_compress_level=args.png_compress_level,
+        executor=args.executor,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight_mb * 1024 * 1024,
+    )
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,148 @@
+"""
+Low level file helpers shared by the extractor and the packer.
+"""
+
+import errno
+import os
+import shutil
+import tempfile
+import threading
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+_SEEK_LOCK = threading.Lock()
+
+# Errors from kernel-side copies that mean "not supported here" rather than
+# a real I/O failure.
+_COPY_FALLBACK_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+    errno.ENOTSOCK,
+}
+
+
+def read_at(handle, offset, size):
+    """Read `size` bytes at `offset` without disturbing other readers.
+
+    Uses `os.pread` where it exists so concurrent readers don't share a file
+    position. Elsewhere (Windows) falls back to seek + read under a lock.
+    """
+    if hasattr(os, "pread"):
+        chunks = []
+        while size > 0:
+            chunk = os.pread(handle.fileno(), size, offset)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    with _SEEK_LOCK:
+        handle.seek(offset)
+        return handle.read(size)
+
+
+def write_at(handle, offset, data):
+    """Write `data` at `offset` of `handle`, bypassing its file position."""
+    handle.flush()
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(handle.fileno(), view, offset)
+            view = view[written:]
+            offset += written
+        return
+
+    with _SEEK_LOCK:
+        handle.seek(offset)
+        handle.write(data)
+        handle.flush()
+
+
+def copy_range(src, dst, src_offset, dst_offset, size):
+    """Copy `size` bytes between two files, inside the kernel where possible.
+
+    Tries `os.copy_file_range` first (which can share extents on CoW file
+    systems), then `os.sendfile`, and falls back to chunked positional reads
+    and writes when neither is available or both are refused. The file
+    position of `dst` is unspecified afterwards.
+    """
+    dst.flush()
+    if hasattr(os, "copy_file_range"):
+        try:
+            while size > 0:
+                copied = os.copy_file_range(
+                    src.fileno(), dst.fileno(), size, src_offset, dst_offset
+                )
+                if copied == 0:
+                    break
+                src_offset += copied
+                dst_offset += copied
+                size -= copied
+        except OSError as err:
+            if err.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+
+    if size > 0 and hasattr(os, "sendfile"):
+        try:
+            os.lseek(dst.fileno(), dst_offset, os.SEEK_SET)
+            while size > 0:
+                copied = os.sendfile(dst.fileno(), src.fileno(), src_offset, size)
+                if copied == 0:
+                    break
+                src_offset += copied
+                dst_offset += copied
+                size -= copied
+        except OSError as err:
+            if err.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+
+    while size > 0:
+        chunk = read_at(src, src_offset, min(size, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError(f"{src.name} ended {size} bytes early")
+        write_at(dst, dst_offset, chunk)
+        src_offset += len(chunk)
+        dst_offset += len(chunk)
+        size -= len(chunk)
+
+
+def atomic_write(path, data):
+    """Replace `path` with `data` so readers never see a partial file."""
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(handle, "wb") as tmp_file:
+            tmp_file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def link_or_copy(src, dst):
+    """Atomically make `dst` a copy of `src`, as a hard link where possible.
+
+    `dst` is replaced, never written to in place, so a hard link never lets
+    writes to one of the paths show up in the other.
+    """
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), suffix=".tmp")
+    os.close(handle)
+    try:
+        os.unlink(tmp_path)
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+        # Renaming a hard link over another link to the same file does
+        # nothing, leaving the temporary link behind.
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
@@ -0,0 +1,281 @@
+"""
+Manifest of the compressed assets kept below a mods directory's `.compressed`.
+
+For every source file that was compressed or extracted it records the size
+and mtime the file had, a digest of its contents and the compressed file
+produced from it, if any.
+A source whose size and mtime still match is known to be up to date without
+reading it, so checking an unchanged tree costs a couple of `stat` calls per
+file. Sources that were only touched are re-hashed once and their entry
+refreshed.
+
+It also records the payload every asset was last extracted from, so
+extracting again after a game update only rewrites the assets that changed,
+and what was last packed into each exe, so updating that exe in place only
+touches the assets that changed.
+"""
+
+import hashlib
+import logging
+import sqlite3
+from dataclasses import dataclass, field
+from pathlib import Path
+
+MANIFEST_NAME = "manifest.sqlite3"
+MANIFEST_VERSION = 1
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def data_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file_:
+        chunk = file_.read(DIGEST_CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = file_.read(DIGEST_CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+@dataclass
+class ManifestEntry:
+    size: int
+    mtime_ns: int
+    digest: str
+    # None for extracted files of unencrypted assets, which aren't compressed.
+    compressed: str
+    compressed_size: int
+
+    @classmethod
+    def for_files(cls, source_stat, digest, mods_dir, compressed_path=None):
+        if compressed_path is None:
+            return cls(source_stat.st_size, source_stat.st_mtime_ns, digest, None, None)
+        return cls(
+            source_stat.st_size,
+            source_stat.st_mtime_ns,
+            digest,
+            Path(compressed_path).relative_to(mods_dir).as_posix(),
+            Path(compressed_path).stat().st_size,
+        )
+
+    def matches_stat(self, stat):
+        return self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+
+@dataclass
+class ExtractionEntry:
+    payload_digest: str
+    settings: str
+
+
+@dataclass
+class PackedEntry:
+    offset: int
+    asset_len: int
+    name_len: int
+    # `AssetData.payload_signature` of what was packed.
+    payload: str
+
+
+@dataclass
+class PackRecord:
+    """What was packed into an exe, to update it without reading it back.
+
+    `source` is the `exe_fingerprint` of the exe it was packed from and
+    `size` and `mtime_ns` are the packed exe's right after packing. `key`
+    is the asset key as hex and `entries` maps asset names to their
+    `PackedEntry`.
+    """
+    source: str
+    size: int
+    mtime_ns: int
+    key: str
+    entries: dict = field(default_factory=dict)
+
+    def matches_stat(self, stat):
+        return self.size == stat.st_size and self.mtime_ns == stat.st_mtime_ns
+
+
+class Manifest:
+    """Entries keyed by the source's path relative to the mods directory.
+
+    Entries are held in memory; `set` may be called from worker threads but
+    `load` and `save` only from the thread that owns the manifest.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        self.dirty = {}
+        self.extractions = {}
+        self.dirty_extractions = {}
+        self.packs = {}
+        self.dirty_packs = {}
+
+    @classmethod
+    def for_mods_dir(cls, mods_dir):
+        manifest = cls(Path(mods_dir) / ".compressed" / MANIFEST_NAME)
+        manifest.load()
+        return manifest
+
+    @staticmethod
+    def key(path):
+        return Path(path).as_posix()
+
+    def load(self):
+        if not self.path.exists():
+            return
+
+        try:
+            conn = _connect(self.path)
+            try:
+                if conn.execute("PRAGMA user_version").fetchone()[0] != MANIFEST_VERSION:
+                    return
+                rows = conn.execute(
+                    "SELECT source, size, mtime_ns, digest, compressed, compressed_size FROM sources"
+                ).fetchall()
+                try:
+                    extraction_rows = conn.execute(
+                        "SELECT asset, payload_digest, settings FROM extractions"
+                    ).fetchall()
+                except sqlite3.OperationalError:
+                    # Written before extractions were recorded.
+                    extraction_rows = []
+                try:
+                    pack_rows = conn.execute(
+                        "SELECT dest, source, size, mtime_ns, key FROM packs"
+                    ).fetchall()
+                    packed_rows = conn.execute(
+                        "SELECT dest, asset, offset, asset_len, name_len, payload FROM packed_assets"
+                    ).fetchall()
+                except sqlite3.OperationalError:
+                    # Written before packs were recorded.
+                    pack_rows = packed_rows = []
+            finally:
+                conn.close()
+        except sqlite3.DatabaseError:
+            logging.warning("Ignoring unreadable manifest %s", self.path)
+            return
+
+        self.entries = {row[0]: ManifestEntry(*row[1:]) for row in rows}
+        self.extractions = {row[0]: ExtractionEntry(*row[1:]) for row in extraction_rows}
+        self.packs = {row[0]: PackRecord(*row[1:]) for row in pack_rows}
+        for dest, asset_name, *entry in packed_rows:
+            if dest in self.packs:
+                self.packs[dest].entries[asset_name] = PackedEntry(*entry)
+
+    def get(self, source):
+        return self.entries.get(self.key(source))
+
+    def set(self, source, entry):
+        source = self.key(source)
+        if self.entries.get(source) == entry:
+            return
+        self.entries[source] = entry
+        self.dirty[source] = entry
+
+    def get_extraction(self, asset_name):
+        """The payload `asset_name` was last extracted from, if any."""
+        return self.extractions.get(asset_name)
+
+    def set_extraction(self, asset_name, entry):
+        if self.extractions.get(asset_name) == entry:
+            return
+        self.extractions[asset_name] = entry
+        self.dirty_extractions[asset_name] = entry
+
+    @staticmethod
+    def dest_key(dest):
+        return str(Path(dest).resolve())
+
+    def get_pack(self, dest):
+        """The `PackRecord` of the last pack written to `dest`, if any."""
+        return self.packs.get(self.dest_key(dest))
+
+    def set_pack(self, dest, record):
+        dest = self.dest_key(dest)
+        self.packs[dest] = record
+        self.dirty_packs[dest] = record
+
+    def save(self):
+        if not self.dirty and not self.dirty_extractions and not self.dirty_packs:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            conn = _connect(self.path)
+        except sqlite3.DatabaseError:
+            logging.warning("Replacing unreadable manifest %s", self.path)
+            self.path.unlink()
+            conn = _connect(self.path)
+
+        try:
+            with conn:
+                if conn.execute("PRAGMA user_version").fetchone()[0] != MANIFEST_VERSION:
+                    conn.execute("DROP TABLE IF EXISTS sources")
+                    conn.execute("DROP TABLE IF EXISTS extractions")
+                    conn.execute("DROP TABLE IF EXISTS packs")
+                    conn.execute("DROP TABLE IF EXISTS packed_assets")
+                    conn.execute(f"PRAGMA user_version = {MANIFEST_VERSION}")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sources ("
+                    " source TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,"
+                    " digest TEXT, compressed TEXT, compressed_size INTEGER)"
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (source, entry.size, entry.mtime_ns, entry.digest,
+                         entry.compressed, entry.compressed_size)
+                        for source, entry in self.dirty.items()
+                    ],
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS extractions ("
+                    " asset TEXT PRIMARY KEY, payload_digest TEXT, settings TEXT)"
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO extractions VALUES (?, ?, ?)",
+                    [
+                        (asset_name, entry.payload_digest, entry.settings)
+                        for asset_name, entry in self.dirty_extractions.items()
+                    ],
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS packs ("
+                    " dest TEXT PRIMARY KEY, source TEXT, size INTEGER, mtime_ns INTEGER, key TEXT)"
+                )
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS packed_assets ("
+                    " dest TEXT, asset TEXT, offset INTEGER, asset_len INTEGER,"
+                    " name_len INTEGER, payload TEXT, PRIMARY KEY (dest, asset))"
+                )
+                for dest, record in self.dirty_packs.items():
+                    conn.execute(
+                        "INSERT OR REPLACE INTO packs VALUES (?, ?, ?, ?, ?)",
+                        (dest, record.source, record.size, record.mtime_ns, record.key),
+                    )
+                    conn.execute("DELETE FROM packed_assets WHERE dest = ?", (dest,))
+                    conn.executemany(
+                        "INSERT INTO packed_assets VALUES (?, ?, ?, ?, ?, ?)",
+                        [
+                            (dest, asset_name, entry.offset, entry.asset_len,
+                             entry.name_len, entry.payload)
+                            for asset_name, entry in record.entries.items()
+                        ],
+                    )
+        finally:
+            conn.close()
+        self.dirty = {}
+        self.dirty_extractions = {}
+        self.dirty_packs = {}
+
+
+def _connect(path):
+    conn = sqlite3.connect(str(path), timeout=30)
+    # Touch the schema so a file that isn't a database fails here.
+    conn.execute("PRAGMA user_version").fetchone()
+    return conn
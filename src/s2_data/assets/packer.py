@@ -1,16 +1,294 @@
 import argparse
+import json
 import logging
 import os
 import shutil
+import struct
 import sys
+import tempfile
+import time
 from pathlib import Path
 
-from .assets import AssetStore, MissingAsset
-from .patcher import Patcher
+from .assets import (TOC_CACHE_DIR, AssetStore, CompressionExecutor,
+                     CompressionFailed, FileConflict, MissingAsset, Overlay)
+from .compression_cache import add_cache_arguments, get_compression_cache
+from .fileio import copy_range, read_at, write_at
+from .manifest import Manifest
+from .patcher import PATCH_REPLACE, Patcher
+from .scan_index import ScanIndex
+from .toc_cache import TocCache, exe_fingerprint
+from .watcher import watch_dirs
 
 EXTRACTED_DIR = Path("Extracted")
 OVERRIDES_DIR = Path("Overrides")
 
+
+class ChecksumOverwritten(Exception):
+    """Raised when the laid out assets reach into the checksum check of the exe."""
+
+
+def is_packed_from(dest, source_handle):
+    """Check that `dest` looks like a previous pack of `source_handle`.
+
+    Packing only ever changes the asset region and the checksum check, so
+    the size and the header before the asset region must match. The asset
+    table of contents of `dest` must also be intact, with the same assets
+    as the source's, encrypted the same way and within the source's region.
+    """
+    if not os.path.exists(dest):
+        return False
+    if os.path.getsize(dest) != os.fstat(source_handle.fileno()).st_size:
+        return False
+
+    with open(dest, "rb") as dest_file:
+        if (
+            read_at(dest_file, 0, AssetStore.DATA_OFFSET)
+            != read_at(source_handle, 0, AssetStore.DATA_OFFSET)
+        ):
+            return False
+        try:
+            dest_store = AssetStore.load_from_file(dest_file)
+        except (AssertionError, struct.error):
+            return False
+
+    source_store = AssetStore.load_from_file(source_handle)
+    return (
+        [asset.encrypted for asset in dest_store.assets]
+        == [asset.encrypted for asset in source_store.assets]
+        and dest_store.total_size <= source_store.total_size
+    )
+
+
+def previous_pack(manifest, source_handle, dest):
+    """The `PackRecord` of `dest` if it is still what was last packed, else None."""
+    record = manifest.get_pack(dest)
+    if record is None or record.source != exe_fingerprint(source_handle):
+        return None
+    if not record.matches_stat(os.stat(dest)):
+        return None
+    return record
+
+
+def record_pack(manifest, asset_store, source_handle, dest):
+    """Remember what was packed into `dest`, see `previous_pack`."""
+    manifest.set_pack(
+        dest, asset_store.pack_record(exe_fingerprint(source_handle), os.stat(dest))
+    )
+    manifest.save()
+
+
+def write_packed_exe(asset_store, source_handle, dest):
+    """Write a packed copy of the source exe to `dest` in a single pass.
+
+    The header, the asset region laid out in `asset_store` and the rest of
+    the source (with the checksum check already patched out) are streamed
+    into a temporary file next to `dest`, which then atomically replaces it.
+    A failed or interrupted pack never leaves a half-written `dest` behind.
+
+    Raises `ChecksumOverwritten` if the assets reach past the checksum check,
+    which only happens when they don't fit, see `AssetStore.layout_report`.
+    """
+    dest = Path(dest)
+    source_size = os.fstat(source_handle.fileno()).st_size
+    patch_offset = Patcher(source_handle).locate()
+
+    tmp_file = tempfile.NamedTemporaryFile(
+        dir=dest.parent, prefix=f".{dest.name}.", suffix=".tmp", delete=False
+    )
+    try:
+        with tmp_file:
+            copy_range(source_handle, tmp_file, 0, 0, AssetStore.DATA_OFFSET)
+            asset_store.pack_assets(tmp_file)
+            tmp_file.flush()
+            position = tmp_file.tell()
+
+            if patch_offset >= position:
+                copy_range(source_handle, tmp_file, position, position, patch_offset - position)
+                logging.info("Found check at 0x{:08x}, replacing with NOPs".format(patch_offset))
+                write_at(tmp_file, patch_offset, PATCH_REPLACE)
+                position = patch_offset + len(PATCH_REPLACE)
+            elif patch_offset != -1:
+                raise ChecksumOverwritten(
+                    f"Checksum check at 0x{patch_offset:08x} was overwritten by assets"
+                )
+
+            copy_range(source_handle, tmp_file, position, position, max(0, source_size - position))
+
+        shutil.copymode(source_handle.name, tmp_file.name)
+        os.replace(tmp_file.name, dest)
+    except BaseException:
+        os.unlink(tmp_file.name)
+        raise
+
+
+def get_search_dirs(args):
+    search_dirs = []
+    for search_dir in args.pack_dir:
+        search_dirs.append(Path(search_dir).relative_to(args.mods_dir))
+    search_dirs.append(OVERRIDES_DIR)
+    return search_dirs
+
+
+def get_overlay(args, scan_index=None):
+    """Stack the pack dirs in the order given with Overrides above all of them."""
+    return Overlay.from_search_dirs(
+        Path(args.mods_dir), get_search_dirs(args),
+        priorities={OVERRIDES_DIR: 1}, scan_index=scan_index,
+    )
+
+
+def log_progress(done, total, asset_data):
+    logging.info("Compressed %s (%d/%d)", asset_data.filename, done, total)
+
+
+def layout(
+    args, asset_store, dry_run=False, cache=None, asset_bundle=None, manifest=None, overlay=None
+):
+    if overlay is None and asset_bundle is None:
+        overlay = get_overlay(args)
+    return asset_store.layout(
+        Path(args.mods_dir), get_search_dirs(args), EXTRACTED_DIR, args.compression_level,
+        dry_run=dry_run, fit=args.auto_compression, cache=cache,
+        asset_bundle=asset_bundle, manifest=manifest, overlay=overlay,
+        executor=CompressionExecutor(args.compression_executor),
+        max_workers=args.compression_workers,
+        progress=log_progress,
+    )
+
+
+def load_and_layout(args, dry_run=False, cache=None, manifest=None, overlay=None):
+    toc_cache = None
+    if not args.no_toc_cache:
+        toc_cache = TocCache(Path(args.mods_dir) / TOC_CACHE_DIR, read_only=dry_run)
+    asset_store = AssetStore.load_from_file(args.source, toc_cache=toc_cache)
+    try:
+        asset_bundle = layout(args, asset_store, dry_run, cache, manifest=manifest, overlay=overlay)
+    except MissingAsset as err:
+        print("")
+        print(f"Failed to find expected asset: {err}. Unabled to proceed...")
+        print("Did you run s2-asset-extract in this directory?")
+        print("")
+        sys.exit(1)
+    except FileConflict as err:
+        print("")
+        print("Some assets are provided by more than one pack:")
+        for name, search_dirs in sorted(err.conflicts.items()):
+            print(f"  {name}: {', '.join(str(search_dir) for search_dir in search_dirs)}")
+        print("Remove all but one of each, or put the one to use in Overrides.")
+        print("")
+        sys.exit(1)
+    except CompressionFailed as err:
+        logging.error("%s", err, exc_info=err.__cause__)
+        sys.exit(1)
+    return asset_store, asset_bundle
+
+
+def update_packed_exe(asset_store, dest, previous=None):
+    """Incrementally update `dest`, a previous pack, and make sure it is patched.
+
+    `previous` is the `PackRecord` of that pack, if known.
+    """
+    with open(dest, "rb+") as dest_file:
+        asset_store.pack_assets_incremental(dest_file, previous)
+
+        patcher = Patcher(dest_file)
+        if patcher.is_patched():
+            logging.info("Asset checksum check is already patched")
+        else:
+            patcher.patch()
+
+
+def watch(args, asset_store, asset_bundle, cache, manifest, overlay):
+    """Repack `args.dest` incrementally whenever a file in the search dirs changes.
+
+    The parsed store, the resolved bundle, the manifest and the overlay of
+    search dirs stay in memory. Only the changed assets are recompressed; the
+    bundle is only resolved again when files are added, removed or renamed,
+    and then only the search dirs they are in are rescanned, listing only the
+    directories that changed.
+    """
+    mods_dir = Path(args.mods_dir)
+    roots = {mods_dir / search_dir: search_dir for search_dir in overlay.layers}
+
+    with watch_dirs(roots) as watcher:
+        logging.info(
+            "Watching %s for changes. Press Ctrl+C to stop.", ", ".join(map(str, roots))
+        )
+        while True:
+            changed = watcher.wait()
+            if not changed:
+                continue
+            start = time.perf_counter()
+
+            if asset_bundle is not None:
+                sources = {asset_data.file_path for asset_data in asset_bundle.asset_datas.values()}
+                if any(path not in sources or not path.exists() for path in changed):
+                    logging.info("Files were added or removed, resolving assets again")
+                    asset_bundle = None
+
+            if asset_bundle is None:
+                for root, search_dir in roots.items():
+                    if any(root in path.parents for path in changed):
+                        overlay.refresh_layer(search_dir)
+            try:
+                asset_bundle = layout(
+                    args, asset_store, cache=cache, asset_bundle=asset_bundle,
+                    manifest=manifest, overlay=overlay,
+                )
+            except (MissingAsset, FileConflict, CompressionFailed) as err:
+                logging.error("Not updating %s: %s", args.dest, err)
+                asset_bundle = None
+                continue
+
+            report = asset_store.layout_report()
+            if not report["fits"]:
+                logging.error(
+                    "Not updating %s: assets are too large by %d bytes",
+                    args.dest, report["size"] - report["original_size"],
+                )
+                continue
+
+            try:
+                update_packed_exe(
+                    asset_store, args.dest, previous_pack(manifest, args.source, args.dest)
+                )
+            except OSError as err:
+                logging.error("Failed to update %s: %s", args.dest, err)
+                continue
+            record_pack(manifest, asset_store, args.source, args.dest)
+            logging.info("Updated %s in %.1f seconds", args.dest, time.perf_counter() - start)
+
+
+def plan(args):
+    """Print the layout a pack would produce. Returns the exit status."""
+    cache = get_compression_cache(args, read_only=True)
+    asset_store, _ = load_and_layout(args, dry_run=True, cache=cache)
+    report = asset_store.layout_report()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_plan(report)
+
+    return 0 if report["fits"] else 1
+
+
+def print_plan(report):
+    size, original_size = report["size"], report["original_size"]
+    print(f"{'Size':>12}  {'Share':>6}  {'Padding':>7}  Asset")
+    for asset in sorted(report["assets"], key=lambda asset: asset["total_size"], reverse=True):
+        print(
+            f"{asset['total_size']:>12}  {asset['total_size'] / original_size:>6.1%}"
+            f"  {asset['padding']:>7}  {asset['filename']} ({asset['source']})"
+        )
+    print("")
+    print(f"Asset region: {size} of {original_size} bytes ({size / original_size:.1%})")
+    if report["fits"]:
+        print(f"{original_size - size} bytes to spare.")
+    else:
+        print(f"Too large by {size - original_size} bytes. Try increasing --compression-level.")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Extract Spelunky 2 Assets.")
 
@@ -35,6 +313,62 @@ def main():
             " - if modified assets are too large, increase compression"
         ),
     )
+    parser.add_argument(
+        "--compression-executor",
+        choices=[executor.value for executor in CompressionExecutor],
+        default=CompressionExecutor.Thread.value,
+        help="Compress assets in a pool of threads or processes (faster for many PNGs).",
+    )
+    parser.add_argument(
+        "--compression-workers",
+        type=int,
+        default=None,
+        help="Maximum number of assets to compress at once. Defaults to the number of cores.",
+    )
+    parser.add_argument(
+        "--auto-compression",
+        action="store_true",
+        help=(
+            "Instead of one --compression-level for everything, start modified assets"
+            " at a fast level and only raise levels where it pays off until the assets"
+            " fit in the original exe."
+        ),
+    )
+    parser.add_argument(
+        "--no-toc-cache",
+        action="store_true",
+        help="Always re-parse the asset table of contents instead of using the cached copy.",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Update an existing dest produced from the same source in place,"
+            " only rewriting assets that changed."
+        ),
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help=(
+            "After packing, keep running and update dest in place whenever a file"
+            " in the Overrides or pack directories changes."
+        ),
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help=(
+            "Only work out the layout and report how much of the asset region"
+            " every asset uses. Nothing is written. Exits with 1 if the assets don't fit."
+        ),
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="With --plan, print the report as JSON.",
+    )
+    add_cache_arguments(parser)
     parser.add_argument(
         "source",
         type=argparse.FileType("rb"),
@@ -43,6 +377,7 @@ def main():
     parser.add_argument(
         "dest",
         type=str,
+        nargs="?",
         default="Spel2-modded.exe",
         help="Path where patched binary will be created.",
     )
@@ -50,35 +385,53 @@ def main():
 
     logging.basicConfig(format="%(levelname)s - %(message)s", level=logging.INFO)
 
-    if os.path.exists(args.dest):
-        answer = input(
-            f"File {args.dest} already exists. Would you like to overwrite it? [y/N]: "
-        )
-        if answer.lower() not in ("y", "yes"):
-            print("Exiting...")
-            sys.exit(0)
+    if args.plan:
+        sys.exit(plan(args))
 
-    print(f"Making copy of {args.source.name} to {args.dest}")
-    shutil.copy2(args.source.name, args.dest)
+    if args.incremental:
+        if not is_packed_from(args.dest, args.source):
+            print(f"{args.dest} wasn't packed from {args.source.name}, unable to update it incrementally.")
+            sys.exit(1)
+    else:
+        if os.path.exists(args.dest):
+            answer = input(
+                f"File {args.dest} already exists. Would you like to overwrite it? [y/N]: "
+            )
+            if answer.lower() not in ("y", "yes"):
+                print("Exiting...")
+                sys.exit(0)
 
-    search_dirs = []
-    for search_dir in args.pack_dir:
-        search_dirs.append(Path(search_dir).relative_to(args.mods_dir))
-    search_dirs.append(OVERRIDES_DIR)
+    cache = get_compression_cache(args)
+    manifest = Manifest.for_mods_dir(args.mods_dir)
+    overlay = get_overlay(args, ScanIndex())
+    asset_store, asset_bundle = load_and_layout(
+        args, cache=cache, manifest=manifest, overlay=overlay
+    )
 
-    with open(args.dest, "rb+") as dest_file:
-        asset_store = AssetStore.load_from_file(dest_file)
+    report = asset_store.layout_report()
+    if not report["fits"]:
+        logging.error(
+            "Not writing %s: assets are too large by %d bytes. Try increasing --compression-level.",
+            args.dest, report["size"] - report["original_size"],
+        )
+        sys.exit(1)
+
+    if args.incremental:
+        update_packed_exe(
+            asset_store, args.dest, previous_pack(manifest, args.source, args.dest)
+        )
+    else:
+        print(f"Writing {args.dest} from {args.source.name}")
+        write_packed_exe(asset_store, args.source, args.dest)
+    record_pack(manifest, asset_store, args.source, args.dest)
+
+    if args.watch:
         try:
-            asset_store.repackage(Path(args.mods_dir), search_dirs, EXTRACTED_DIR, args.compression_level)
-        except MissingAsset as err:
-            print("")
-            print(f"Failed to find expected asset: {err}. Unabled to proceed...")
-            print("Did you run s2-asset-extract in this directory?")
-            print("")
-            sys.exit(1)
+            watch(args, asset_store, asset_bundle, cache, manifest, overlay)
+        except KeyboardInterrupt:
+            print("Stopped watching.")
 
-        patcher = Patcher(dest_file)
-        patcher.patch()
+    cache.evict()
 
 
 if __name__ == "__main__":
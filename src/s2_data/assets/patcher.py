@@ -46,12 +46,19 @@ class Patcher:
 
             self.exe_handle.seek(self.exe_handle.tell() - overlap)
 
-    def patch(self):
-        logging.info("Patching asset checksum check")
+    def is_patched(self):
+        return self.find(PATCH_REPLACE) != -1
+
+    def locate(self):
+        """Find the checksum check without modifying anything.
+
+        Returns the offset to write `PATCH_REPLACE` at, or -1 if the check
+        wasn't found or doesn't have the expected form.
+        """
         index = self.find(PATCH_START)
         if index == -1:
             logging.warning("Didn't find instructions to patch. Is game unmodified?")
-            return False
+            return -1
 
         self.exe_handle.seek(index)
         ops = self.exe_handle.read(14)
@@ -62,8 +69,17 @@ class Patcher:
                 "to be updated for the current game version."
             )
             logging.warning("(Expected 0x{:02x}, found 0x{:02x})".format(PATCH_END, ops[-1]))
+            return -1
+
+        return index
+
+    def patch(self):
+        logging.info("Patching asset checksum check")
+        index = self.locate()
+        if index == -1:
             return False
 
         logging.info("Found check at 0x{:08x}, replacing with NOPs".format(index))
         self.exe_handle.seek(index)
         self.exe_handle.write(PATCH_REPLACE)
+        return True
@@ -0,0 +1,114 @@
+"""
+Index of the files below mod directories.
+
+Listing a directory is only repeated when its mtime changed, which happens
+whenever an entry is added to, removed from or renamed in it. Walking an
+unchanged tree therefore costs one `stat` per directory and nothing per
+file. Keep a `ScanIndex` around and pass it to every
+`AssetBundle.from_dirs` call to benefit from it.
+"""
+
+import os
+import time
+from dataclasses import dataclass, field
+
+# Directories modified this recently (in nanoseconds) before they were
+# listed are listed again next time. A change made in the same mtime tick
+# as the listing would otherwise go unnoticed. Two seconds covers FAT.
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+
+@dataclass
+class DirListing:
+    mtime_ns: int
+    scanned_ns: int
+    files: list
+    subdirs: list
+    file_set: frozenset = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.file_set = frozenset(self.files)
+
+    def is_current(self, stat):
+        return (
+            stat.st_mtime_ns == self.mtime_ns
+            and self.mtime_ns < self.scanned_ns - RACY_WINDOW_NS
+        )
+
+
+class ScanIndex:
+    def __init__(self, exclude=(".compressed",)):
+        self.exclude = frozenset(exclude)
+        self.dirs = {}
+        self.listings = 0
+
+    def walk(self, root):
+        """Yield `(dir_path, filenames)` for `root` and every directory below it.
+
+        Visits directories in the same order as a top-down `os.walk`, with
+        `dir_path` as a string. Directories named in `exclude` and symlinked
+        directories aren't descended into.
+        """
+        stack = [os.fspath(root)]
+        while stack:
+            dir_path = stack.pop()
+            listing = self.listing(dir_path)
+            if listing is None:
+                continue
+            yield dir_path, listing.files
+            stack.extend(os.path.join(dir_path, subdir) for subdir in reversed(listing.subdirs))
+
+    def refresh(self, root):
+        for _ in self.walk(root):
+            pass
+
+    def contains(self, path):
+        """Whether `path` is a file as of the last walk over its directory."""
+        dir_path, filename = os.path.split(os.fspath(path))
+        listing = self.dirs.get(dir_path)
+        return listing is not None and filename in listing.file_set
+
+    def listing(self, dir_path):
+        try:
+            stat = os.stat(dir_path)
+        except OSError:
+            self.forget(dir_path)
+            return None
+
+        listing = self.dirs.get(dir_path)
+        if listing is not None and listing.is_current(stat):
+            return listing
+
+        scanned_ns = time.time_ns()
+        files = []
+        subdirs = []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if not is_dir:
+                        files.append(entry.name)
+                    elif entry.name not in self.exclude and not entry.is_symlink():
+                        subdirs.append(entry.name)
+        except OSError:
+            # Like os.walk, skip directories that can't be listed.
+            self.forget(dir_path)
+            return None
+        self.listings += 1
+
+        if listing is not None:
+            for removed in set(listing.subdirs) - set(subdirs):
+                self.forget(os.path.join(dir_path, removed))
+
+        listing = DirListing(stat.st_mtime_ns, scanned_ns, files, subdirs)
+        self.dirs[dir_path] = listing
+        return listing
+
+    def forget(self, dir_path):
+        """Drop `dir_path` and everything below it from the index."""
+        prefix = os.path.join(dir_path, "")
+        for path in [path for path in self.dirs if path == dir_path or path.startswith(prefix)]:
+            del self.dirs[path]
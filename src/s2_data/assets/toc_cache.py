@@ -0,0 +1,91 @@
+"""
+Persistent cache of parsed asset tables of contents.
+
+Parsing the table of contents means walking every asset header, replaying
+`Key.update` for each of them and hashing every known filename. None of that
+changes for a given executable, so the result is stored in a small JSON file
+named after a cheap fingerprint of the exe and reused on the next run.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from .fileio import atomic_write
+from .known_assets import KNOWN_ASSETS
+
+TOC_CACHE_VERSION = 1
+
+# Bytes hashed from each end of the executable for the fingerprint. The PE
+# header (and its link timestamp) lives at the start of the file.
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+_KNOWN_ASSETS_DIGEST = hashlib.blake2b(b"\n".join(KNOWN_ASSETS), digest_size=8).hexdigest()
+
+
+def exe_fingerprint(exe_handle):
+    """Fingerprint an executable from its size, mtime and a sample of its contents."""
+    stat = os.fstat(exe_handle.fileno())
+    fingerprint = hashlib.blake2b(digest_size=16)
+    fingerprint.update(f"{stat.st_size}:{stat.st_mtime_ns}:".encode())
+
+    position = exe_handle.tell()
+    exe_handle.seek(0)
+    fingerprint.update(exe_handle.read(FINGERPRINT_SAMPLE_SIZE))
+    exe_handle.seek(max(0, stat.st_size - FINGERPRINT_SAMPLE_SIZE))
+    fingerprint.update(exe_handle.read(FINGERPRINT_SAMPLE_SIZE))
+    exe_handle.seek(position)
+
+    return fingerprint.hexdigest()
+
+
+class TocCache:
+    def __init__(self, cache_dir, read_only=False):
+        self.cache_dir = Path(cache_dir)
+        # A read only cache is used for dry runs, which must not write anything.
+        self.read_only = read_only
+
+    def path_for(self, fingerprint):
+        return self.cache_dir / f"{fingerprint}.json"
+
+    def load(self, exe_handle):
+        """Return the cached table of contents for `exe_handle`, or None."""
+        fingerprint = exe_fingerprint(exe_handle)
+        path = self.path_for(fingerprint)
+        if not path.exists():
+            return None
+
+        try:
+            with path.open("r") as cache_file:
+                toc = json.load(cache_file)
+        except (OSError, ValueError):
+            logging.warning("Ignoring unreadable TOC cache %s", path)
+            return None
+
+        if (
+            toc.get("version") != TOC_CACHE_VERSION
+            or toc.get("fingerprint") != fingerprint
+            or toc.get("known_assets") != _KNOWN_ASSETS_DIGEST
+        ):
+            return None
+
+        logging.info("Using cached table of contents %s", path)
+        return toc
+
+    def store(self, exe_handle, toc):
+        if self.read_only:
+            return
+
+        fingerprint = exe_fingerprint(exe_handle)
+        toc = dict(
+            toc,
+            version=TOC_CACHE_VERSION,
+            fingerprint=fingerprint,
+            known_assets=_KNOWN_ASSETS_DIGEST,
+        )
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # Concurrent runs never see a partially written cache.
+        atomic_write(self.path_for(fingerprint), json.dumps(toc).encode())
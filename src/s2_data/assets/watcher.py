@@ -0,0 +1,202 @@
+"""
+Watch mod directories for changed files.
+
+On Linux changes are reported by inotify, called through ctypes. Everywhere
+else, or if inotify isn't usable, the directories are polled by comparing the
+size and mtime of every file.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+
+# Seconds without further changes before a batch of changes is reported, so
+# an editor saving a file in several steps triggers a single update.
+SETTLE_TIME = 0.3
+POLL_INTERVAL = 1.0
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+class Watcher:
+    def __init__(self, roots):
+        self.roots = [Path(root) for root in roots]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def wait(self, timeout=None):
+        """Block until files change and return the set of their paths.
+
+        Returns an empty set if nothing changed within `timeout` seconds.
+        """
+        raise NotImplementedError
+
+
+class PollingWatcher(Watcher):
+    def __init__(self, roots, interval=POLL_INTERVAL):
+        super().__init__(roots)
+        self.interval = interval
+        self.files = self.snapshot()
+
+    def snapshot(self):
+        files = {}
+        for root in self.roots:
+            for dir_path, _, filenames in os.walk(root):
+                for filename in filenames:
+                    path = Path(dir_path) / filename
+                    try:
+                        stat = path.stat()
+                    except FileNotFoundError:
+                        continue
+                    files[path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def changes(self, files):
+        return {
+            path for path in self.files.keys() | files.keys()
+            if self.files.get(path) != files.get(path)
+        }
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        changed = set()
+        while True:
+            time.sleep(min(self.interval, SETTLE_TIME) if changed else self.interval)
+            files = self.snapshot()
+            new_changes = self.changes(files)
+            self.files = files
+            if new_changes:
+                changed |= new_changes
+            elif changed:
+                return changed
+            elif deadline is not None and time.monotonic() >= deadline:
+                return changed
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, roots):
+        super().__init__(roots)
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+        self.dirs = {}
+        try:
+            for root in self.roots:
+                if root.is_dir():
+                    self.add_tree(root)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def add_tree(self, root):
+        """Watch `root` and every directory below it. Returns the files found."""
+        files = set()
+        for dir_path, _, filenames in os.walk(root):
+            dir_path = Path(dir_path)
+            wd = self._add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err), str(dir_path))
+            self.dirs[wd] = dir_path
+            files.update(dir_path / filename for filename in filenames)
+        return files
+
+    def read_events(self):
+        changed = set()
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("Missed file changes, treating every file as changed")
+                changed.update(self.add_tree_files())
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+
+            dir_path = self.dirs.get(wd)
+            if dir_path is None:
+                continue
+            path = dir_path / os.fsdecode(name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have been created before the watch was added.
+                    changed.update(self.add_tree(path))
+            else:
+                changed.add(path)
+        return changed
+
+    def add_tree_files(self):
+        files = set()
+        for root in self.roots:
+            for dir_path, _, filenames in os.walk(root):
+                files.update(Path(dir_path) / filename for filename in filenames)
+        return files
+
+    def wait(self, timeout=None):
+        changed = set()
+        while True:
+            if changed:
+                wait_time = SETTLE_TIME
+            else:
+                wait_time = timeout
+            ready, _, _ = select.select([self.fd], [], [], wait_time)
+            if not ready:
+                return changed
+            changed |= self.read_events()
+
+
+def watch_dirs(roots):
+    """Watch `roots` with inotify where available, polling otherwise."""
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(roots)
+        except (OSError, AttributeError) as err:
+            logging.info("inotify unavailable (%s), polling for changes instead", err)
+    return PollingWatcher(roots)
@@ -0,0 +1,581 @@
+import errno
+import io
+import os
+import random
+import threading
+import types
+import tempfile
+from pathlib import Path
+from struct import pack
+from unittest import TestCase, main
+from unittest.mock import patch
+
+import zstandard as zstd
+from PIL import Image
+
+from s2_data.assets.assets import (AssetBundle, AssetData, AssetStore,
+                                   CompressionFailed, FileConflict, Overlay,
+                                   ResolutionPolicy, decode_dds, to_dds)
+from s2_data.assets.chacha import Key, chacha, filename_hash
+from s2_data.assets.compression_cache import CompressionCache
+from s2_data.assets.extractor import (AssetSelection, InFlightBudget,
+                                      extract_asset, extract_assets)
+from s2_data.assets.fileio import copy_range, link_or_copy
+from s2_data.assets.manifest import Manifest
+from s2_data.assets.toc_cache import TocCache
+
+
+ASSETS = [
+    (b'Data/Levels/abzu.lvl', b'level data' * 1000),
+    (b'strings00.str', b'strings'),
+    (b'shaders.hlsl', bytes(range(256)) * 3),
+]
+ENCRYPTED = {b'Data/Levels/abzu.lvl', b'shaders.hlsl'}
+
+
+def build_exe(assets=ASSETS, encrypted_names=ENCRYPTED):
+    """Build a minimal exe with `assets` after the header."""
+    payloads = [
+        zstd.ZstdCompressor().compress(data) if name in encrypted_names else data
+        for name, data in assets
+    ]
+    key = Key()
+    for payload in payloads:
+        key.update(len(payload) + 1)
+
+    exe = bytearray(b'\xAA' * AssetStore.DATA_OFFSET)
+    for (name, _), payload in zip(assets, payloads):
+        encrypted = name in encrypted_names
+        if encrypted:
+            payload = chacha(name, payload, key.key)
+        exe += pack('<II', len(payload) + 1, len(name))
+        exe += filename_hash(name, key.key)
+        exe += pack('<b', encrypted)
+        exe += payload
+    exe += pack('<II', 0, 0)
+    exe += b'\xBB' * 64
+    return bytes(exe)
+
+
+def random_words(count, seed=0):
+    """Text that zstd compresses noticeably better at higher levels."""
+    rand = random.Random(seed)
+    words = [bytes(rand.choices(b'abcdefghij', k=rand.randint(3, 8))) for _ in range(300)]
+    return b' '.join(rand.choices(words, k=count))
+
+
+class AssetStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.exe_path = os.path.join(self.tmp_dir.name, 'Spel2.exe')
+        with open(self.exe_path, 'wb') as exe:
+            exe.write(build_exe())
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_load_and_resolve_names(self):
+        with open(self.exe_path, 'rb') as exe:
+            asset_store = AssetStore.load_from_file(exe)
+            asset_store.populate_asset_names()
+
+            self.assertEqual(
+                [asset.filename for asset in asset_store.assets],
+                [name for name, _ in ASSETS],
+            )
+            self.assertEqual(
+                [asset.encrypted for asset in asset_store.assets],
+                [name in ENCRYPTED for name, _ in ASSETS],
+            )
+
+    def test_mmap_matches_file(self):
+        with open(self.exe_path, 'rb') as exe:
+            from_file = AssetStore.load_from_file(exe)
+            from_mmap = AssetStore.load_from_file(exe, use_mmap=True)
+
+            self.assertEqual(from_file.key, from_mmap.key)
+            self.assertEqual(
+                [repr(asset) for asset in from_file.assets],
+                [repr(asset) for asset in from_mmap.assets],
+            )
+            for file_asset, mmap_asset in zip(from_file.assets, from_mmap.assets):
+                from_file.load_data(file_asset)
+                self.assertIsInstance(mmap_asset.data, memoryview)
+                self.assertEqual(file_asset.data, bytes(mmap_asset.data))
+            from_mmap.close()
+
+    def test_open_streams_decrypted_contents(self):
+        for use_mmap in (False, True):
+            with open(self.exe_path, 'rb') as exe, self.subTest(use_mmap=use_mmap):
+                asset_store = AssetStore.load_from_file(exe, use_mmap=use_mmap)
+                for name, data in ASSETS:
+                    with asset_store.open(name, chunk_size=100) as reader:
+                        chunks = iter(lambda: reader.read(33), b'')
+                        self.assertEqual(b''.join(chunks), data)
+
+                self.assertEqual(
+                    [(asset.filename, reader.read()) for asset, reader in asset_store.iter_assets()],
+                    ASSETS,
+                )
+                asset_store.close()
+
+    def test_find_asset_by_hash_prefix(self):
+        asset_store = AssetStore(None)
+        offset = AssetStore.DATA_OFFSET
+        hashes = [
+            b'prefix00-first',
+            b'prefix00-second',  # Same indexed prefix as the first.
+            b'short',  # Shorter than the prefix, e.g. a truncated name.
+            b'another-hash',
+        ]
+        assets = []
+        for name_hash in hashes:
+            assets.append(asset_store.add_asset(offset, 10, len(name_hash), name_hash, False, 0))
+            offset += 100
+
+        self.assertIs(asset_store.find_asset_by_hash(b'prefix00-first'), assets[0])
+        self.assertIs(asset_store.find_asset_by_hash(b'prefix00-second'), assets[1])
+        self.assertIs(asset_store.find_asset_by_hash(b'short-and-longer'), assets[2])
+        self.assertIs(asset_store.find_asset_by_hash(b'anoth'), assets[3])
+        self.assertIsNone(asset_store.find_asset_by_hash(b'prefix00-third'))
+
+        # The index is rebuilt once assets are added.
+        third = asset_store.add_asset(offset, 10, 14, b'prefix00-third', False, 0)
+        self.assertIs(asset_store.find_asset_by_hash(b'prefix00-third'), third)
+
+    def test_toc_cache_roundtrip(self):
+        toc_cache = TocCache(os.path.join(self.tmp_dir.name, 'toc'))
+        with open(self.exe_path, 'rb') as exe:
+            self.assertIsNone(toc_cache.load(exe))
+            parsed = AssetStore.load_from_file(exe, toc_cache=toc_cache)
+            self.assertIsNotNone(toc_cache.load(exe))
+            cached = AssetStore.load_from_file(exe, toc_cache=toc_cache)
+
+        self.assertTrue(cached.names_populated)
+        self.assertEqual(parsed.key, cached.key)
+        self.assertEqual(
+            [repr(asset) for asset in parsed.assets],
+            [repr(asset) for asset in cached.assets],
+        )
+
+    def test_compression_cache_lru_eviction(self):
+        cache = CompressionCache(os.path.join(self.tmp_dir.name, 'cache'))
+        old = cache.compress_data(b'old' * 1000, 3, 'aa' * 16)
+        new = cache.compress_data(b'new' * 1000, 3, 'bb' * 16)
+        os.utime(old.path, ns=(0, 0))
+        os.utime(new.path, ns=(1, 1))
+
+        # A hit refreshes the entry, making `new` the least recently used.
+        self.assertEqual(cache.compress_data(b'', 3, 'aa' * 16).size, old.size)
+
+        cache.max_size = old.size
+        self.assertEqual(cache.evict(), new.size)
+        self.assertIsNotNone(cache.get('aa' * 16, 3, False))
+        self.assertIsNone(cache.get('bb' * 16, 3, False))
+
+    def test_compression_cache_keeps_linked_entries(self):
+        cache = CompressionCache(os.path.join(self.tmp_dir.name, 'cache'))
+        linked = cache.compress_data(b'linked' * 1000, 3, 'aa' * 16)
+        unlinked = cache.compress_data(b'unlinked' * 1000, 3, 'bb' * 16)
+        os.link(linked.path, os.path.join(self.tmp_dir.name, 'linked.zst'))
+
+        cache.max_size = 0
+        self.assertEqual(cache.evict(), unlinked.size)
+        self.assertIsNotNone(cache.get('aa' * 16, 3, False))
+
+    def test_packing_reuses_texture_compressed_on_extraction(self):
+        name = b'Data/Textures/OldTextures/ai.DDS'
+        image = Image.new('RGBA', (8, 4), (10, 20, 30, 255))
+        with open(self.exe_path, 'wb') as exe:
+            exe.write(build_exe([(name, to_dds(image))], encrypted_names={name}))
+        mods_dir = Path(self.tmp_dir.name) / 'Mods'
+        texture_dir = Path('Data') / 'Textures' / 'OldTextures'
+        (mods_dir / 'Extracted' / texture_dir).mkdir(parents=True)
+        (mods_dir / '.compressed' / 'Extracted' / texture_dir).mkdir(parents=True)
+        cache = CompressionCache(os.path.join(self.tmp_dir.name, 'cache'))
+
+        with open(self.exe_path, 'rb') as exe:
+            asset_store = AssetStore.load_from_file(exe)
+            asset_store.populate_asset_names()
+            asset = asset_store.assets[0]
+            asset_store.load_data(asset)
+            asset.extract(mods_dir, 'Extracted', asset_store.key, compression_level=3, cache=cache)
+
+        asset_data = AssetData(mods_dir, Path('Extracted'), texture_dir / 'ai.png', asset)
+        with patch.object(AssetData, 'source_data') as source_data:
+            cached = cache.compress(asset_data, 3)
+            source_data.assert_not_called()
+
+        self.assertEqual(cached.path.read_bytes(), asset_data.compressed_path.read_bytes())
+        self.assertEqual(
+            zstd.ZstdDecompressor().decompress(cached.path.read_bytes()),
+            asset_data.source_data(),
+        )
+
+    def test_manifest_skips_unchanged_sources(self):
+        mods_dir = Path(self.tmp_dir.name) / 'Mods'
+        source = mods_dir / 'Overrides' / 'abzu.lvl'
+        source.parent.mkdir(parents=True)
+        source.write_bytes(b'level data')
+        with open(self.exe_path, 'rb') as exe:
+            asset = AssetStore.load_from_file(exe).assets[0]
+
+        def asset_data():
+            manifest = Manifest.for_mods_dir(mods_dir)
+            return AssetData(
+                mods_dir, Path('Overrides'), Path('abzu.lvl'), asset,
+                manifest_entry=manifest.get('Overrides/abzu.lvl'),
+            )
+
+        compressed = asset_data()
+        self.assertTrue(compressed.needs_compression())
+        manifest = Manifest.for_mods_dir(mods_dir)
+        manifest.set('Overrides/abzu.lvl', compressed.compress(3))
+        manifest.save()
+
+        with patch('s2_data.assets.assets.file_digest') as file_digest:
+            self.assertFalse(asset_data().needs_compression())
+            file_digest.assert_not_called()
+
+        # Touching the source only costs a hash.
+        os.utime(source, ns=(0, 0))
+        self.assertFalse(asset_data().needs_compression())
+
+        source.write_bytes(b'changed level data')
+        self.assertTrue(asset_data().needs_compression())
+
+    def test_reextraction_skips_unchanged_payloads(self):
+        mods_dir = Path(self.tmp_dir.name) / 'Mods'
+        (mods_dir / 'Extracted' / 'Data' / 'Levels').mkdir(parents=True)
+        (mods_dir / '.compressed' / 'Extracted' / 'Data' / 'Levels').mkdir(parents=True)
+
+        def extract(exe_data):
+            with open(self.exe_path, 'wb') as exe:
+                exe.write(exe_data)
+            manifest = Manifest.for_mods_dir(mods_dir)
+            extracted = {}
+            with open(self.exe_path, 'rb') as exe:
+                asset_store = AssetStore.load_from_file(exe)
+                asset_store.populate_asset_names()
+                for asset in asset_store.assets:
+                    filepath, _ = asset.extract_paths(mods_dir, 'Extracted')
+                    changed, entries = extract_asset(
+                        asset_store, asset, mods_dir, asset_store.key, {},
+                        manifest.get_extraction(asset.filename.decode()),
+                        manifest.get(filepath.relative_to(mods_dir)),
+                    )
+                    entries.apply(manifest)
+                    extracted[asset.filename] = changed
+            manifest.save()
+            return extracted
+
+        self.assertEqual(extract(build_exe()), dict.fromkeys(dict(ASSETS), True))
+        self.assertEqual(extract(build_exe()), dict.fromkeys(dict(ASSETS), False))
+
+        # Resizing one asset re-keys all of them, but the others are unchanged.
+        updated = [(b'strings00.str', b'more strings') if name == b'strings00.str' else (name, data)
+                   for name, data in ASSETS]
+        self.assertEqual(extract(build_exe(updated)), {
+            b'Data/Levels/abzu.lvl': False, b'strings00.str': True, b'shaders.hlsl': False,
+        })
+
+        (mods_dir / 'Extracted' / 'shaders.hlsl').unlink()
+        self.assertTrue(extract(build_exe(updated))[b'shaders.hlsl'])
+
+        # Unencrypted files edited in place are extracted again too.
+        (mods_dir / 'Extracted' / 'strings00.str').write_bytes(b'edited strings')
+        self.assertTrue(extract(build_exe(updated))[b'strings00.str'])
+        self.assertEqual((mods_dir / 'Extracted' / 'strings00.str').read_bytes(), b'more strings')
+
+    def test_extraction_keeps_game_payload(self):
+        mods_dir = Path(self.tmp_dir.name) / 'Mods'
+        (mods_dir / 'Extracted').mkdir(parents=True)
+        (mods_dir / '.compressed' / 'Extracted').mkdir(parents=True)
+        with open(self.exe_path, 'rb') as exe:
+            asset_store = AssetStore.load_from_file(exe)
+            asset_store.populate_asset_names()
+            asset = asset_store.assets[2]
+            asset_store.load_data(asset)
+            asset.extract(mods_dir, 'Extracted', asset_store.key)
+
+        self.assertEqual((mods_dir / 'Extracted' / 'shaders.hlsl').read_bytes(), ASSETS[2][1])
+        self.assertEqual(
+            (mods_dir / '.compressed' / 'Extracted' / 'shaders.hlsl.zst').read_bytes(),
+            zstd.ZstdCompressor().compress(ASSETS[2][1]),
+        )
+
+    def shrink_layout(self, dry_run):
+        # The game's payloads are compressed at zstd's default level, so
+        # recompressing `words` wins back far more than the override grows.
+        text = random_words(20000)
+        name = b'Data/Levels/Arena/dm1-1.lvl'
+        with open(self.exe_path, 'wb') as exe:
+            exe.write(build_exe(ASSETS + [(name, text)], ENCRYPTED | {name}))
+        mods_dir = Path(self.tmp_dir.name) / 'Mods'
+        cache_dir = Path(self.tmp_dir.name) / 'cache'
+        cache = CompressionCache(cache_dir)
+        with open(self.exe_path, 'rb') as exe:
+            extract_assets(exe, mods_dir, cache=cache)
+        (mods_dir / 'Overrides').mkdir(exist_ok=True)
+        (mods_dir / 'Overrides' / 'strings00.str').write_bytes(b'strings' * 200)
+        cached_before = sorted(cache_dir.rglob('*'))
+
+        exe = open(self.exe_path, 'rb')
+        self.addCleanup(exe.close)
+        asset_store = AssetStore.load_from_file(exe)
+        with patch.object(AssetData, 'content_digest', autospec=True,
+                          side_effect=AssetData.content_digest) as content_digest:
+            asset_store.layout(
+                mods_dir, [Path('Overrides')], Path('Extracted'), dry_run=dry_run, cache=cache,
+            )
+        # Up to date sources are recompressed without being hashed again.
+        self.assertNotIn(name, [call.args[0].asset.filename for call in content_digest.call_args_list])
+        cached = [path for path in sorted(cache_dir.rglob('*')) if path not in cached_before]
+        return asset_store, cached
+
+    def test_layout_fits_after_shrinking(self):
+        asset_store, cached = self.shrink_layout(dry_run=False)
+        report = asset_store.layout_report()
+        self.assertLessEqual(report['size'], report['original_size'])
+        self.assertTrue(cached)
+        words = asset_store.find_asset(b'Data/Levels/Arena/dm1-1.lvl')
+        self.assertIn(words.asset_data.payload_path, cached)
+
+    def test_dry_run_shrinking_writes_nothing(self):
+        asset_store, cached = self.shrink_layout(dry_run=True)
+        report = asset_store.layout_report()
+        self.assertLessEqual(report['size'], report['original_size'])
+        self.assertEqual(cached, [])
+        words = asset_store.find_asset(b'Data/Levels/Arena/dm1-1.lvl')
+        self.assertIsNone(words.asset_data.payload_path)
+
+    def fit_layout(self, assets, encrypted_names, overrides):
+        with open(self.exe_path, 'wb') as exe:
+            exe.write(build_exe(assets, encrypted_names))
+        mods_dir = Path(self.tmp_dir.name) / 'Mods'
+        cache = CompressionCache(Path(self.tmp_dir.name) / 'cache')
+        with open(self.exe_path, 'rb') as exe:
+            extract_assets(exe, mods_dir, cache=cache)
+        (mods_dir / 'Overrides').mkdir(exist_ok=True)
+        for name, data in overrides.items():
+            (mods_dir / 'Overrides' / name).write_bytes(data)
+
+        exe = open(self.exe_path, 'rb')
+        self.addCleanup(exe.close)
+        asset_store = AssetStore.load_from_file(exe)
+        asset_store.layout(mods_dir, [Path('Overrides')], Path('Extracted'), fit=True, cache=cache)
+        return asset_store
+
+    def test_fit_raises_levels_until_the_assets_fit(self):
+        # The game compressed the level at 3, the first level tried, so the
+        # longer override only fits at a higher one.
+        name = b'Data/Levels/Arena/dm1-1.lvl'
+        text = random_words(20000)
+        asset_store = self.fit_layout(
+            ASSETS + [(name, text)], ENCRYPTED | {name},
+            {'dm1-1.lvl': text + random_words(200, seed=1)},
+        )
+
+        report = asset_store.layout_report()
+        self.assertTrue(report['fits'])
+        payload_path = asset_store.find_asset(name).asset_data.payload_path
+        self.assertRegex(payload_path.name, r'-(7|12|16|19|22)\.zst$')
+
+    def test_fit_reports_broken_sources(self):
+        name = b'Data/Textures/OldTextures/ai.DDS'
+        image = Image.new('RGBA', (8, 4), (10, 20, 30, 255))
+        with self.assertRaises(CompressionFailed) as failed:
+            self.fit_layout(
+                ASSETS + [(name, to_dds(image))], ENCRYPTED | {name}, {'ai.png': b'not a png'},
+            )
+        self.assertIn('ai.png', str(failed.exception))
+
+    def test_asset_selection(self):
+        levels = AssetSelection(['Data/Levels/**/*.lvl'], exclude=['Data/Levels/Arena/**'])
+        self.assertTrue(levels.matches(b'Data/Levels/abzu.lvl'))
+        self.assertTrue(levels.matches(b'Data/Levels/Deep/abzu.lvl'))
+        self.assertFalse(levels.matches(b'Data/Levels/Arena/dm1-1.lvl'))
+        self.assertFalse(levels.matches(b'Data/Levels/abzu.tok'))
+
+        textures = AssetSelection(types=['dds'])
+        self.assertTrue(textures.matches(b'Data/Textures/ai.DDS'))
+        self.assertFalse(textures.matches(b'shaders.hlsl'))
+
+        self.assertTrue(AssetSelection(categories=['strings']).matches(b'strings00.str'))
+        self.assertTrue(AssetSelection().selects_all)
+
+    def test_selective_extraction_reads_only_selected(self):
+        mods_dir = Path(self.tmp_dir.name) / 'Mods'
+        cache = CompressionCache(os.path.join(self.tmp_dir.name, 'cache'))
+        with open(self.exe_path, 'rb') as exe, \
+                patch.object(AssetStore, 'load_data', autospec=True,
+                             side_effect=AssetStore.load_data) as load_data:
+            extracted = extract_assets(
+                exe, mods_dir, AssetSelection(categories=['levels']), cache=cache
+            )
+
+        self.assertEqual(extracted, ['Data/Levels/abzu.lvl'])
+        self.assertEqual(
+            [call.args[1].filename for call in load_data.call_args_list],
+            [b'Data/Levels/abzu.lvl'],
+        )
+        self.assertTrue((mods_dir / 'Extracted' / 'Data' / 'Levels' / 'abzu.lvl').exists())
+        self.assertFalse((mods_dir / 'Extracted' / 'shaders.hlsl').exists())
+
+    def test_in_flight_budget(self):
+        budget = InFlightBudget(100)
+        budget.acquire(60)
+        acquired = threading.Event()
+
+        def acquire(size):
+            budget.acquire(size)
+            acquired.set()
+
+        # Waits until the first payload is released.
+        waiting = threading.Thread(target=acquire, args=(60,))
+        waiting.start()
+        self.assertFalse(acquired.wait(0.1))
+        budget.release(60)
+        waiting.join(5)
+        self.assertTrue(acquired.is_set())
+        budget.release(60)
+
+        # A payload over the limit goes through alone rather than never.
+        budget.acquire(30)
+        acquired.clear()
+        waiting = threading.Thread(target=acquire, args=(500,))
+        waiting.start()
+        self.assertFalse(acquired.wait(0.1))
+        budget.release(30)
+        waiting.join(5)
+        self.assertTrue(acquired.is_set())
+        self.assertEqual(budget.in_flight, 500)
+
+    def test_extraction_with_assets_over_the_budget(self):
+        mods_dir = Path(self.tmp_dir.name) / 'Mods'
+        cache = CompressionCache(os.path.join(self.tmp_dir.name, 'cache'))
+        extracted = []
+
+        def extract():
+            with open(self.exe_path, 'rb') as exe:
+                extracted.extend(extract_assets(exe, mods_dir, cache=cache, workers=2, max_in_flight=1))
+
+        # Run in a thread so a deadlock fails the test instead of hanging it.
+        extraction = threading.Thread(target=extract, daemon=True)
+        extraction.start()
+        extraction.join(30)
+        self.assertFalse(extraction.is_alive())
+        self.assertEqual(extracted, sorted(name.decode() for name, _ in ASSETS))
+
+    def test_overlay_priorities_and_conflicts(self):
+        mods_dir = Path(self.tmp_dir.name) / 'Mods'
+        for path in ('Packs/A/abzu.lvl', 'Packs/B/Data/abzu.lvl', 'Packs/A/shaders.hlsl',
+                     'Packs/B/shaders.hlsl', 'Overrides/shaders.hlsl', 'Packs/A/strings00.str',
+                     'Packs/B/strings00.str'):
+            (mods_dir / path).parent.mkdir(parents=True, exist_ok=True)
+            (mods_dir / path).write_bytes(b'x')
+        packs = [Path('Packs/A'), Path('Packs/B')]
+
+        overlay = Overlay.from_search_dirs(
+            mods_dir, packs + [Path('Overrides')], priorities={Path('Overrides'): 1}
+        )
+        self.assertEqual(overlay.winner('shaders.hlsl'), (Path('Overrides'), Path('shaders.hlsl')))
+        self.assertEqual(overlay.conflicts, {'abzu.lvl': packs, 'strings00.str': packs})
+
+        with open(self.exe_path, 'rb') as exe:
+            asset_store = AssetStore.load_from_file(exe)
+            asset_store.populate_asset_names()
+        with self.assertRaises(FileConflict) as conflict:
+            AssetBundle.from_dirs(asset_store, mods_dir, None, Path('Extracted'), overlay=overlay)
+        self.assertEqual(conflict.exception.conflicts, {'abzu.lvl': packs, 'strings00.str': packs})
+        self.assertEqual(
+            str(conflict.exception),
+            'abzu.lvl found in multiple packs: Packs/A, Packs/B;'
+            ' strings00.str found in multiple packs: Packs/A, Packs/B',
+        )
+
+        overlay.remove_layer(Path('Packs/A'))
+        self.assertEqual(overlay.conflicts, {})
+        self.assertEqual(overlay.winner('abzu.lvl'), (Path('Packs/B'), Path('Data/abzu.lvl')))
+
+        last_wins = Overlay.from_search_dirs(mods_dir, packs, ResolutionPolicy.LastWins)
+        self.assertEqual(last_wins.conflicts, {})
+        self.assertEqual(last_wins.winner('abzu.lvl'), (Path('Packs/B'), Path('Data/abzu.lvl')))
+
+    def test_to_dds_zeroes_transparent_pixels(self):
+        rgba = bytes(range(256)) * 3 + bytes([255, 255, 255, 0]) * 16
+        img = Image.frombytes('RGBA', (8, 26), rgba)
+
+        dds = to_dds(img)
+        self.assertEqual(dds[:4], b'DDS ')
+        self.assertEqual(len(dds), 128 + len(rgba))
+        self.assertEqual(
+            dds[128:],
+            bytes(
+                byte if rgba[i + 3] != 0 else 0
+                for i in range(0, len(rgba), 4)
+                for byte in rgba[i:i + 4]
+            ),
+        )
+
+    def test_decode_dds_matches_pillow(self):
+        img = Image.frombytes('RGBA', (7, 5), bytes(range(140)))
+        dds = to_dds(img)
+
+        pillow = Image.open(io.BytesIO(dds))
+        pillow.tile[0] = pillow.tile[0][:-1] + ((pillow.tile[0][-1][0][::-1], 0, 1),)
+        self.assertEqual(decode_dds(dds).tobytes(), pillow.tobytes())
+
+    def test_link_or_copy_over_same_file(self):
+        tmp_dir = Path(self.tmp_dir.name)
+        (tmp_dir / 'src').write_bytes(b'payload')
+        (tmp_dir / 'out').mkdir()
+        for _ in range(2):
+            link_or_copy(tmp_dir / 'src', tmp_dir / 'out' / 'dst')
+
+        self.assertEqual(os.listdir(tmp_dir / 'out'), ['dst'])
+        self.assertEqual((tmp_dir / 'out' / 'dst').read_bytes(), b'payload')
+
+    def test_copy_range_fallbacks(self):
+        tmp_dir = Path(self.tmp_dir.name)
+        data = bytes(range(256)) * 40
+        (tmp_dir / 'src').write_bytes(data)
+        partial = []
+
+        def refuse(*args):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        def copy_some(src, dst, count, offset_src, offset_dst):
+            # Copies part of the range, then refuses like a cross-device copy.
+            if partial:
+                refuse()
+            partial.append(count)
+            return os.pwrite(dst, os.pread(src, 1000, offset_src), offset_dst)
+
+        def fake_os(**replaced):
+            attrs = {attr: getattr(os, attr) for attr in dir(os) if not attr.startswith('__')}
+            attrs.update(replaced)
+            return types.SimpleNamespace(**{attr: value for attr, value in attrs.items() if value is not None})
+
+        cases = {
+            'kernel': os,
+            'no copy_file_range': fake_os(copy_file_range=None),
+            'neither': fake_os(copy_file_range=None, sendfile=None),
+            'both refused': fake_os(copy_file_range=refuse, sendfile=refuse),
+            'partial copy_file_range': fake_os(copy_file_range=copy_some),
+            'partial copy_file_range, sendfile refused': fake_os(copy_file_range=copy_some, sendfile=refuse),
+        }
+        for case, fake in cases.items():
+            with self.subTest(case):
+                partial.clear()
+                with open(tmp_dir / 'src', 'rb') as src, open(tmp_dir / 'dst', 'wb+') as dst:
+                    dst.write(b'\xff' * 16)
+                    with patch('s2_data.assets.fileio.os', fake), \
+                            patch('s2_data.assets.fileio.COPY_CHUNK_SIZE', 4096):
+                        copy_range(src, dst, 100, 16, len(data) - 200)
+                self.assertEqual((tmp_dir / 'dst').read_bytes(), b'\xff' * 16 + data[100:-100])
+
+
+if __name__ == '__main__':
+    main()
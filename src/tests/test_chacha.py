@@ -0,0 +1,80 @@
+import hashlib
+from unittest import TestCase, main
+
+from s2_data.assets.chacha import (chacha, chacha_key, chacha_keys,
+                                   filename_hash, filename_hashes, sxor,
+                                   xor_blocks)
+from s2_data.assets.known_assets import KNOWN_ASSETS
+
+
+KEY = 0x0123456789ABCDEF
+NAME = b'Data/Levels/abzu.lvl'
+DATA = bytes(range(256)) * 41 + b'tail'
+
+
+class ChachaTestCase(TestCase):
+
+    def test_chacha_known_output(self):
+        """Output must stay byte-identical to what the game expects."""
+        expected = {
+            0: 'd41d8cd98f00b204e9800998ecf8427e',
+            1: 'cd25041f9f36811b04ab3015805fe816',
+            63: '833762371658f6bb15d7d04c9ead39b4',
+            64: '391fc04f90ae6f93ecbf9fd5f30f1c58',
+            65: 'efce587157e0e2473fd9c40182928492',
+            len(DATA): '572fcf24da627d8f8b2692a656667539',
+        }
+        for size, digest in expected.items():
+            with self.subTest(size=size):
+                out = chacha(NAME, DATA[:size], KEY)
+                self.assertEqual(hashlib.md5(out).hexdigest(), digest)
+
+    def test_chacha_roundtrip(self):
+        encrypted = chacha(NAME, DATA, KEY)
+        self.assertNotEqual(encrypted, DATA)
+        self.assertEqual(chacha(NAME, encrypted, KEY), DATA)
+
+    def test_xor_blocks_matches_sxor(self):
+        block = bytes(range(0x40, 0x80))
+        for size in (0, 0x40, 0x40 * 7, 0x40 * 7 + 5):
+            with self.subTest(size=size):
+                data = DATA[:size]
+                blocks = size // 0x40
+                self.assertEqual(
+                    xor_blocks(data, block),
+                    sxor(data, block * blocks),
+                )
+
+    def test_filename_hash_known_output(self):
+        self.assertEqual(
+            filename_hash(NAME, KEY).hex(),
+            '04938d887edc68af625f37cb4980c5a696c8a5e3',
+        )
+
+    def test_filename_hashes_matches_scalar(self):
+        # Include names spanning several 64 byte partials.
+        names = KNOWN_ASSETS + [b'', b'a' * 0x40, b'b' * 0x41, b'c' * 0x90]
+        for key in (0, KEY, 2 ** 64 - 1):
+            with self.subTest(key=key):
+                self.assertEqual(
+                    filename_hashes(names, key),
+                    [filename_hash(name, key) for name in names],
+                )
+
+    def test_chacha_keys_matches_scalar(self):
+        names = KNOWN_ASSETS[:20] + [b'c' * 0x90]
+        sizes = [i * 4099 for i in range(len(names))]
+        for key in (0, KEY, 2 ** 64 - 1):
+            with self.subTest(key=key):
+                self.assertEqual(
+                    chacha_keys(names, key, sizes),
+                    [chacha_key(name, size, key) for name, size in zip(names, sizes)],
+                )
+
+    def test_chacha_accepts_memoryview(self):
+        view = memoryview(bytearray(DATA))
+        self.assertEqual(chacha(NAME, view, KEY), chacha(NAME, DATA, KEY))
+
+
+if __name__ == '__main__':
+    main()
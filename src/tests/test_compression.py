@@ -0,0 +1,119 @@
+import io
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from pathlib import Path
+from unittest import TestCase, main
+from unittest.mock import mock_open, patch
+
+from s2_data.assets.assets import (AssetData, CompressionFailed,
+                                   available_memory, schedule_compression)
+from s2_data.assets.packer import main as pack_main
+
+from .test_assets import build_exe
+
+
+class FakeJob:
+    def __init__(self, name, size):
+        self.file_path = Path(name)
+        self.size = size
+
+    def estimated_source_size(self):
+        return self.size
+
+
+class ScheduleCompressionTestCase(TestCase):
+
+    def setUp(self):
+        self.jobs = [FakeJob(name, size) for name, size in (('b', 20), ('a', 10), ('d', 40), ('c', 30))]
+
+    def test_largest_first(self):
+        started = []
+        results = list(schedule_compression(
+            self.jobs, lambda job: started.append(job) or job.size, 3, max_workers=1,
+        ))
+
+        self.assertEqual([job.size for job in started], [40, 30, 20, 10])
+        self.assertEqual([(job.size, result) for job, result in results], [(40, 40), (30, 30), (20, 20), (10, 10)])
+
+    def test_progress(self):
+        progress = []
+        list(schedule_compression(
+            self.jobs, lambda job: None, 3,
+            progress=lambda done, total, job: progress.append((done, total, job)),
+        ))
+
+        self.assertEqual([(done, total) for done, total, _ in progress], [(1, 4), (2, 4), (3, 4), (4, 4)])
+        self.assertCountEqual([job for _, _, job in progress], self.jobs)
+
+    def test_first_failure_cancels_the_rest(self):
+        started = []
+        lock = threading.Lock()
+
+        def task(job):
+            with lock:
+                started.append(job)
+            if job.size == 40:
+                raise ValueError('broken')
+            # Leaves time to cancel every job that hasn't started.
+            time.sleep(0.1)
+
+        with self.assertRaises(CompressionFailed) as failed:
+            list(schedule_compression(self.jobs, task, 3, max_workers=1))
+
+        self.assertIn('d', str(failed.exception))
+        self.assertIsInstance(failed.exception.__cause__, ValueError)
+        self.assertLessEqual(len(started), 2)
+
+    def test_no_jobs(self):
+        self.assertEqual(list(schedule_compression([], lambda job: None, 3)), [])
+
+
+class AvailableMemoryTestCase(TestCase):
+
+    def test_mem_available(self):
+        meminfo = 'MemTotal:       16384 kB\nMemFree:         1024 kB\nMemAvailable:    8192 kB\n'
+        with patch('builtins.open', mock_open(read_data=meminfo)):
+            self.assertEqual(available_memory(), 8192 * 1024)
+
+    def test_falls_back_to_total_memory(self):
+        with patch('builtins.open', side_effect=FileNotFoundError), \
+                patch('os.sysconf', side_effect=lambda name: {'SC_PHYS_PAGES': 4, 'SC_PAGE_SIZE': 4096}[name]):
+            self.assertEqual(available_memory(), 4 * 4096)
+
+
+class CompressionFailedTestCase(TestCase):
+
+    def test_pack_exits_on_compression_failure(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_path = Path(tmp_dir)
+            exe_path = tmp_path / 'Spel2.exe'
+            exe_path.write_bytes(build_exe())
+            mods_dir = tmp_path / 'Mods'
+            override = mods_dir / 'Overrides' / 'shaders.hlsl'
+            override.parent.mkdir(parents=True)
+            override.write_bytes(b'shader')
+            (mods_dir / 'Extracted').mkdir()
+            for name in ('strings00.str', 'Data/Levels/abzu.lvl'):
+                (mods_dir / 'Extracted' / name).parent.mkdir(parents=True, exist_ok=True)
+                (mods_dir / 'Extracted' / name).write_bytes(b'data')
+
+            dest = tmp_path / 'Spel2-modded.exe'
+            argv = [
+                's2-asset-pack', '--mods-dir', str(mods_dir), '--cache-dir', str(tmp_path / 'cache'),
+                str(exe_path), str(dest),
+            ]
+            with patch('sys.argv', argv), redirect_stdout(io.StringIO()), \
+                    patch.object(AssetData, 'compress', side_effect=OSError('disk full')), \
+                    self.assertLogs(level='ERROR') as logs:
+                with self.assertRaises(SystemExit) as exit_status:
+                    pack_main()
+
+            self.assertEqual(exit_status.exception.code, 1)
+            self.assertIn('disk full', '\n'.join(logs.output))
+            self.assertFalse(dest.exists())
+
+
+if __name__ == '__main__':
+    main()
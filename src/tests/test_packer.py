@@ -0,0 +1,291 @@
+import io
+import tempfile
+from contextlib import redirect_stdout
+from pathlib import Path
+from struct import pack
+from unittest import TestCase, main
+from unittest.mock import patch
+
+import zstandard as zstd
+
+from s2_data.assets.assets import (AssetBundle, AssetData, AssetStore,
+                                   CompressionExecutor)
+from s2_data.assets.chacha import chacha
+from s2_data.assets.compression_cache import CompressionCache
+from s2_data.assets.extractor import extract_assets
+from s2_data.assets.manifest import Manifest
+from s2_data.assets.packer import (ChecksumOverwritten, is_packed_from,
+                                   main as pack_main, previous_pack,
+                                   record_pack, update_packed_exe,
+                                   write_packed_exe)
+from s2_data.assets.patcher import PATCH_REPLACE, PATCH_START, Patcher
+
+from .test_assets import build_exe
+
+
+class PackerTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_path = Path(self.tmp_dir.name)
+        self.exe_path = self.tmp_path / 'Spel2.exe'
+        self.exe_path.write_bytes(build_exe())
+        self.mods_dir = self.tmp_path / 'Mods'
+        self.cache = CompressionCache(self.tmp_path / 'cache')
+        with self.exe_path.open('rb') as exe:
+            extract_assets(exe, self.mods_dir, cache=self.cache)
+        self.manifest = Manifest.for_mods_dir(self.mods_dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def layout(self):
+        exe = self.exe_path.open('rb')
+        self.addCleanup(exe.close)
+        asset_store = AssetStore.load_from_file(exe)
+        asset_store.layout(
+            self.mods_dir, [Path('Overrides')], Path('Extracted'),
+            cache=self.cache, manifest=self.manifest,
+        )
+        return exe, asset_store
+
+    def test_write_packed_exe_matches_packing_in_place(self):
+        # Give the exe a checksum check after the assets to patch out.
+        check = PATCH_START + b'\x11' * 5 + b'\xcc'
+        self.exe_path.write_bytes(self.exe_path.read_bytes() + check + b'\xcc' * 32)
+        override = self.mods_dir / 'Overrides' / 'shaders.hlsl'
+        override.parent.mkdir(parents=True, exist_ok=True)
+        override.write_bytes(b'shader')
+        exe, asset_store = self.layout()
+
+        dest = self.tmp_path / 'Spel2-modded.exe'
+        write_packed_exe(asset_store, exe, dest)
+
+        in_place = self.tmp_path / 'in-place.exe'
+        in_place.write_bytes(self.exe_path.read_bytes())
+        with in_place.open('rb+') as out:
+            asset_store.pack_assets(out)
+            self.assertTrue(Patcher(out).patch())
+
+        self.assertIn(PATCH_REPLACE, dest.read_bytes())
+        self.assertEqual(dest.read_bytes(), in_place.read_bytes())
+        self.assertEqual(list(self.tmp_path.glob('.*.tmp')), [])
+
+    def test_failed_write_leaves_dest_intact(self):
+        dest = self.tmp_path / 'Spel2-modded.exe'
+        dest.write_bytes(b'previous pack')
+        exe, asset_store = self.layout()
+
+        with patch.object(AssetStore, 'pack_assets', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                write_packed_exe(asset_store, exe, dest)
+
+        self.assertEqual(dest.read_bytes(), b'previous pack')
+        self.assertEqual(list(self.tmp_path.glob('.*.tmp')), [])
+
+    def test_assets_overwriting_the_checksum_check_fail(self):
+        check = PATCH_START + b'\x11' * 5 + b'\xcc'
+        self.exe_path.write_bytes(self.exe_path.read_bytes() + check)
+        override = self.mods_dir / 'Overrides' / 'strings00.str'
+        override.parent.mkdir(parents=True, exist_ok=True)
+        override.write_bytes(b'strings' * 500)
+        exe, asset_store = self.layout()
+
+        dest = self.tmp_path / 'Spel2-modded.exe'
+        with self.assertRaises(ChecksumOverwritten):
+            write_packed_exe(asset_store, exe, dest)
+        self.assertFalse(dest.exists())
+
+    def test_pack_refuses_assets_that_dont_fit(self):
+        dest = self.tmp_path / 'Spel2-modded.exe'
+        exe, asset_store = self.layout()
+        write_packed_exe(asset_store, exe, dest)
+        record_pack(self.manifest, asset_store, exe, dest)
+        before = dest.read_bytes()
+
+        override = self.mods_dir / 'Overrides' / 'strings00.str'
+        override.parent.mkdir(parents=True, exist_ok=True)
+        override.write_bytes(b'strings' * 500)
+        for incremental in (False, True):
+            with self.subTest(incremental=incremental):
+                argv = [
+                    's2-asset-pack', '--mods-dir', str(self.mods_dir),
+                    '--cache-dir', str(self.tmp_path / 'cache'), str(self.exe_path), str(dest),
+                ]
+                if incremental:
+                    argv.insert(1, '--incremental')
+                with patch('sys.argv', argv), patch('builtins.input', return_value='y'), \
+                        self.assertLogs(level='ERROR') as logs:
+                    with self.assertRaises(SystemExit) as exit_status:
+                        pack_main()
+
+                self.assertEqual(exit_status.exception.code, 1)
+                self.assertIn('too large', '\n'.join(logs.output))
+                self.assertEqual(dest.read_bytes(), before)
+
+    def test_incremental_pack_only_rewrites_changed_assets(self):
+        dest = self.tmp_path / 'Spel2-modded.exe'
+        exe, asset_store = self.layout()
+        write_packed_exe(asset_store, exe, dest)
+        record_pack(self.manifest, asset_store, exe, dest)
+        before = dest.read_bytes()
+        self.assertTrue(is_packed_from(dest, exe))
+
+        # Same size, so every other asset keeps its offset and encryption.
+        override = self.mods_dir / 'Overrides' / 'strings00.str'
+        override.parent.mkdir(parents=True, exist_ok=True)
+        override.write_bytes(b'STRINGS')
+
+        exe, asset_store = self.layout()
+        previous = previous_pack(self.manifest, exe, dest)
+        self.assertIsNotNone(previous)
+        with patch.object(AssetData, 'get_data', autospec=True) as get_data:
+            update_packed_exe(asset_store, dest, previous)
+            get_data.assert_not_called()
+
+        after = dest.read_bytes()
+        changed = asset_store.find_asset(b'strings00.str')
+        self.assertEqual(after[:changed.data_offset], before[:changed.data_offset])
+        self.assertEqual(after[changed.data_offset:changed.data_offset + 7], b'STRINGS')
+
+        full = self.tmp_path / 'full.exe'
+        write_packed_exe(asset_store, exe, full)
+        self.assertEqual(after, full.read_bytes())
+
+    def test_previous_pack_is_dropped_once_dest_changes(self):
+        dest = self.tmp_path / 'Spel2-modded.exe'
+        exe, asset_store = self.layout()
+        write_packed_exe(asset_store, exe, dest)
+        record_pack(self.manifest, asset_store, exe, dest)
+        self.assertIsNotNone(previous_pack(self.manifest, exe, dest))
+
+        dest.write_bytes(dest.read_bytes() + b'\0')
+        self.assertIsNone(previous_pack(self.manifest, exe, dest))
+
+    def test_is_packed_from_checks_the_asset_table(self):
+        dest = self.tmp_path / 'Spel2-modded.exe'
+        exe, asset_store = self.layout()
+        write_packed_exe(asset_store, exe, dest)
+        self.assertTrue(is_packed_from(dest, exe))
+
+        data = bytearray(dest.read_bytes())
+        data[AssetStore.DATA_OFFSET:AssetStore.DATA_OFFSET + 4] = b'\xff\xff\xff\x7f'
+        dest.write_bytes(data)
+        self.assertFalse(is_packed_from(dest, exe))
+
+    def test_pipelined_pack_matches_sequential(self):
+        override = self.mods_dir / 'Overrides' / 'shaders.hlsl'
+        override.parent.mkdir(parents=True, exist_ok=True)
+        override.write_bytes(b'shader' * 100)
+        exe, asset_store = self.layout()
+
+        sequential = b''
+        for asset in asset_store.assets:
+            if asset.filename is None:
+                continue
+            data = asset.asset_data.get_data()
+            if asset.encrypted:
+                data = chacha(asset.filename, data, asset_store.key)
+            sequential += asset_store.entry_header(asset) + data
+
+        for workers, depth in ((1, 1), (2, 2), (4, 8)):
+            with self.subTest(workers=workers, depth=depth):
+                entries = asset_store.packed_entries(workers=workers, depth=depth)
+                pipelined = b''.join(
+                    header + (data.read_bytes() if isinstance(data, Path) else data)
+                    for _, header, data in entries
+                )
+                self.assertEqual(pipelined, sequential)
+
+        dest = self.tmp_path / 'packed.exe'
+        dest.write_bytes(self.exe_path.read_bytes())
+        with dest.open('rb+') as out:
+            asset_store.pack_assets(out)
+        start = AssetStore.DATA_OFFSET
+        self.assertEqual(dest.read_bytes()[start:start + len(sequential) + 8], sequential + pack('<II', 0, 0))
+
+    def test_plan_reuses_cached_compression(self):
+        override = self.mods_dir / 'Overrides' / 'shaders.hlsl'
+        override.parent.mkdir(parents=True, exist_ok=True)
+        override.write_bytes(b'shader' * 100)
+        _, asset_store = self.layout()
+        packed = asset_store.layout_report()
+        # Only the shared cache still has the compressed override.
+        asset_store.find_asset(b'shaders.hlsl').asset_data.compressed_path.unlink()
+
+        exe = self.exe_path.open('rb')
+        self.addCleanup(exe.close)
+        planned_store = AssetStore.load_from_file(exe)
+        with patch('zstandard.ZstdCompressor') as compressor:
+            planned_store.layout(
+                self.mods_dir, [Path('Overrides')], Path('Extracted'),
+                dry_run=True, cache=self.cache, manifest=self.manifest,
+            )
+            compressor.assert_not_called()
+        self.assertEqual(planned_store.layout_report(), packed)
+
+    def test_process_compression_drops_stale_payloads(self):
+        override = self.mods_dir / 'Overrides' / 'shaders.hlsl'
+        override.parent.mkdir(parents=True, exist_ok=True)
+        override.write_bytes(b'shader')
+        _, asset_store = self.layout()
+        asset_data = asset_store.find_asset(b'shaders.hlsl').asset_data
+        asset_bundle = AssetBundle({'shaders.hlsl': asset_data})
+        # E.g. picked by shrink_compressed before the source changed.
+        asset_data.payload_path = self.tmp_path / 'stale.zst'
+        override.write_bytes(b'new shader')
+
+        asset_bundle.compress(cache=self.cache, executor=CompressionExecutor.Process)
+        self.assertIsNone(asset_data.payload_path)
+        self.assertEqual(zstd.ZstdDecompressor().decompress(asset_data.get_data()), b'new shader')
+
+    def test_plan_writes_nothing(self):
+        override = self.mods_dir / 'Overrides' / 'shaders.hlsl'
+        override.parent.mkdir(parents=True, exist_ok=True)
+        override.write_bytes(bytes(range(256)) * 2)
+
+        def snapshot():
+            return {
+                path: path.stat().st_mtime_ns
+                for path in self.tmp_path.rglob('*') if path.is_file()
+            }
+
+        before = snapshot()
+        argv = [
+            's2-asset-pack', '--plan', '--auto-compression', '--mods-dir', str(self.mods_dir),
+            '--cache-dir', str(self.tmp_path / 'cache'), str(self.exe_path),
+        ]
+        with patch('sys.argv', argv), redirect_stdout(io.StringIO()) as stdout:
+            with self.assertRaises(SystemExit) as exit_status:
+                pack_main()
+
+        self.assertEqual(exit_status.exception.code, 0)
+        self.assertIn('shaders.hlsl', stdout.getvalue())
+        self.assertEqual(snapshot(), before)
+
+    def test_conflicts_are_reported(self):
+        for pack_dir in ('A', 'B'):
+            for name in ('abzu.lvl', 'strings00.str'):
+                path = self.mods_dir / 'Packs' / pack_dir / name
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(b'x')
+
+        dest = self.tmp_path / 'Spel2-modded.exe'
+        argv = [
+            's2-asset-pack', '--mods-dir', str(self.mods_dir),
+            '--pack-dir', str(self.mods_dir / 'Packs' / 'A'),
+            '--pack-dir', str(self.mods_dir / 'Packs' / 'B'),
+            '--cache-dir', str(self.tmp_path / 'cache'), str(self.exe_path), str(dest),
+        ]
+        with patch('sys.argv', argv), redirect_stdout(io.StringIO()) as stdout:
+            with self.assertRaises(SystemExit) as exit_status:
+                pack_main()
+
+        self.assertEqual(exit_status.exception.code, 1)
+        self.assertIn('  abzu.lvl: Packs/A, Packs/B\n', stdout.getvalue())
+        self.assertIn('  strings00.str: Packs/A, Packs/B\n', stdout.getvalue())
+        self.assertFalse(dest.exists())
+
+
+if __name__ == '__main__':
+    main()
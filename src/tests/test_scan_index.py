@@ -0,0 +1,55 @@
+import os
+import tempfile
+from pathlib import Path
+from unittest import TestCase, main
+
+from s2_data.assets.scan_index import ScanIndex
+
+
+class ScanIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name) / 'Packs'
+        for path in ('a.lvl', 'Data/b.lvl', 'Data/Levels/c.lvl', 'Other/d.png', '.compressed/e.zst'):
+            (self.root / path).parent.mkdir(parents=True, exist_ok=True)
+            (self.root / path).write_bytes(b'x')
+        self.age_dirs()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def age_dirs(self):
+        # Directories modified just now are always listed again.
+        for dir_path, _, _ in os.walk(self.root):
+            os.utime(dir_path, ns=(0, 0))
+
+    def walk(self, scan_index):
+        return [(dir_path, sorted(files)) for dir_path, files in scan_index.walk(self.root)]
+
+    def test_walk_matches_os_walk(self):
+        expected = []
+        for dir_path, dirs, files in os.walk(self.root):
+            dirs[:] = [dir_ for dir_ in dirs if dir_ != '.compressed']
+            expected.append((dir_path, sorted(files)))
+        self.assertEqual(self.walk(ScanIndex()), expected)
+
+    def test_only_changed_directories_are_listed(self):
+        scan_index = ScanIndex()
+        first = self.walk(scan_index)
+        self.assertEqual(scan_index.listings, 4)
+
+        self.assertEqual(self.walk(scan_index), first)
+        self.assertEqual(scan_index.listings, 4)
+        self.assertTrue(scan_index.contains(self.root / 'Data' / 'Levels' / 'c.lvl'))
+
+        (self.root / 'Data' / 'Levels' / 'c.lvl').unlink()
+        (self.root / 'Data' / 'Levels' / 'f.lvl').write_bytes(b'x')
+        self.walk(scan_index)
+        self.assertEqual(scan_index.listings, 5)
+        self.assertFalse(scan_index.contains(self.root / 'Data' / 'Levels' / 'c.lvl'))
+        self.assertTrue(scan_index.contains(self.root / 'Data' / 'Levels' / 'f.lvl'))
+
+
+if __name__ == '__main__':
+    main()
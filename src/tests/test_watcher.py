@@ -0,0 +1,43 @@
+import sys
+import tempfile
+from pathlib import Path
+from unittest import TestCase, main, skipUnless
+
+from s2_data.assets.watcher import InotifyWatcher, PollingWatcher
+
+
+class WatcherTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.tmp_dir.name) / 'Overrides'
+        (self.root / 'Data').mkdir(parents=True)
+        self.existing = self.root / 'Data' / 'abzu.lvl'
+        self.existing.write_bytes(b'level')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def check_watcher(self, watcher):
+        with watcher:
+            self.assertEqual(watcher.wait(timeout=0.1), set())
+
+            self.existing.write_bytes(b'changed level')
+            (self.root / 'Textures').mkdir()
+            (self.root / 'Textures' / 'ai.png').write_bytes(b'png')
+
+            self.assertEqual(
+                watcher.wait(timeout=5),
+                {self.existing, self.root / 'Textures' / 'ai.png'},
+            )
+
+    def test_polling_watcher(self):
+        self.check_watcher(PollingWatcher([self.root], interval=0.05))
+
+    @skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_inotify_watcher(self):
+        self.check_watcher(InotifyWatcher([self.root]))
+
+
+if __name__ == '__main__':
+    main()